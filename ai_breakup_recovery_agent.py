@@ -12,6 +12,21 @@ import yaml
 import random
 import json
 import re
+import argparse
+import io
+import hashlib
+import hmac
+import gc
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from types import SimpleNamespace
+from contextlib import contextmanager
+from PIL import Image as PILImage
 from decouple import config as env_config, UndefinedValueError
 import atexit
 import streamlit_analytics2 as streamlit_analytics
@@ -22,19 +37,298 @@ from google.oauth2 import service_account
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@st.cache_resource(show_spinner=False)
+def freeze_import_graph():
+    """
+    Moves everything alive after the imports (agno, google-genai, pydantic...) out of the
+    garbage collector's reach, once per process. Streamlit runs gc.collect() after every
+    rerun, and walking that graph took ~100ms of each ~150ms interaction.
+    """
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Froze {gc.get_freeze_count()} long-lived objects out of the garbage collector")
+
+
+freeze_import_graph()
+
 # Constants
 CONFIG_PATH = Path(__file__).parent / "config" / "prompts.yaml"
+CRISIS_EVAL_PATH = Path(__file__).parent / "data" / "crisis_triage_eval.jsonl"
 MAX_INPUT_LENGTH = 5000
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 MAX_FILES = 5
-
-# Track temp files for cleanup
-temp_files_created = []
+MAX_IMAGE_DIMENSION = 2048  # px, longest edge sent to Gemini
+IMAGE_PREP_WORKERS = 2
+IMAGE_PREP_TIMEOUT = 30  # seconds to wait for a screenshot still being prepared on submit
+THUMBNAIL_SIZE = 480  # px, longest edge of upload previews
+RENDER_TIMING_LOG_LEVEL = logging.INFO if env_config("LOG_RENDER_TIMINGS", default=False, cast=bool) else logging.DEBUG
 
 # Firestore credentials temp file path
 _firestore_temp_key_path = None
 
 
+# Hide Streamlit branding (keep menu for user features like Print)
+# Using !important to override Streamlit Cloud's injected styles
+HIDE_STREAMLIT_STYLE = """
+        <style>
+        /* 1. Remove the "Deploy" button */
+        .stDeployButton {
+            display: none !important;
+        }
+        
+        /* 2. Remove the "Fork this app" / GitHub Ribbon / Toolbar */
+        [data-testid="stToolbar"] {
+            display: none !important;
+        }
+        
+        /* 3. Remove the Footer */
+        footer {
+            display: none !important;
+        }
+        
+        /* 4. Remove decoration and status widgets */
+        div[data-testid="stDecoration"] {
+            display: none !important;
+        }
+        div[data-testid="stStatusWidget"] {
+            display: none !important;
+        }
+        
+        /* 5. Hide header branding elements but keep menu button visible */
+        /* Hide the header container's content (logo, title, etc.) */
+        header[data-testid="stHeader"] > div:first-child,
+        header[data-testid="stHeader"] > div:nth-child(2) {
+            display: none !important;
+        }
+        
+        /* 6. Explicitly show hamburger menu - multiple selectors for compatibility */
+        #MainMenu {
+            display: block !important;
+            visibility: visible !important;
+            opacity: 1 !important;
+        }
+        button[kind="header"],
+        button[data-testid="baseButton-header"],
+        header button[aria-label*="menu"],
+        header button[aria-label*="Menu"] {
+            display: block !important;
+            visibility: visible !important;
+            opacity: 1 !important;
+        }
+        
+        /* 7. Hide "View app source" button if present */
+        button[title="View app source"],
+        button[title="View the source code"] {
+            display: none !important;
+        }
+        
+        /* 8. Move the main content up so there is no white gap at the top */
+        .block-container {
+            padding-top: 1rem !important;
+        }
+        </style>
+    """
+# Comments and indentation are stripped once so every full rerun sends the smallest payload
+HIDE_STREAMLIT_STYLE = re.sub(r"\s+", " ", re.sub(r"/\*.*?\*/", "", HIDE_STREAMLIT_STYLE, flags=re.S)).strip()
+
+
+# Fallback circuit breaker settings if config/prompts.yaml has no `resilience` section
+DEFAULT_RESILIENCE_CONFIG = {
+    "gemini": {"window_seconds": 120, "min_calls": 4, "error_rate": 0.5, "slow_call_seconds": 90, "slow_call_rate": 0.8, "open_seconds": 60},
+    "duckduckgo": {"window_seconds": 300, "min_calls": 3, "error_rate": 0.5, "slow_call_seconds": 15, "slow_call_rate": 0.5, "open_seconds": 300},
+    "firestore": {"window_seconds": 120, "min_calls": 3, "error_rate": 0.5, "slow_call_seconds": 10, "slow_call_rate": 0.5, "open_seconds": 60},
+}
+MAX_QUEUED_WAITLIST_WRITES = 500
+WAITLIST_QUEUE_PATH = Path(tempfile.gettempdir()) / "breakup_recovery_waitlist_queue.json"
+# Packages whose exception messages carry the HTTP status code (agno, google-genai, google-api-core, httpx...)
+PROVIDER_ERROR_MODULES = ("agno.", "google.", "httpx", "httpcore", "requests.", "urllib3.", "ddgs", "duckduckgo_search")
+# Exception class names (httpx, ddgs, google-api-core...) that mean the dependency is unreachable or overloaded
+TRANSIENT_ERROR_NAMES = ("Timeout", "Connect", "Transport", "Network", "Unavailable", "DeadlineExceeded", "Ratelimit", "RetryError")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open"""
+
+
+def get_error_status_code(error: Exception) -> Optional[int]:
+    """
+    HTTP status code of a provider error, from its attributes or its message.
+    The message is only parsed for errors raised by provider/HTTP client libraries,
+    so our own ValueError("expected 500 items") isn't read as a 5xx.
+    """
+    for attribute in ("status_code", "code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    if not type(error).__module__.startswith(PROVIDER_ERROR_MODULES):
+        return None
+    match = re.search(r"\b(4\d\d|5\d\d)\b", str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_dependency_failure(error: Exception) -> bool:
+    """
+    Whether an error says the dependency is unhealthy (5xx, 429, timeouts, connection errors)
+    rather than that our request was bad (other 4xx) or our own code failed (KeyError, ValueError...)
+    """
+    status_code = get_error_status_code(error)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    for cause in (error, error.__cause__):
+        if isinstance(cause, (TimeoutError, ConnectionError)):
+            return True
+        if cause is not None and any(name in type(cause).__name__ for name in TRANSIENT_ERROR_NAMES):
+            return True
+    return False
+
+
+class CircuitBreaker:
+    """
+    Per-dependency circuit breaker driven by a rolling window of outcomes.
+    - closed: calls go through; opens when the error rate or slow-call rate in the window crosses its threshold
+    - open: calls fail fast until open_seconds have passed
+    - half_open: one probe call is let through; success closes the breaker, failure reopens it
+    """
+
+    def __init__(self, name: str, window_seconds: float, min_calls: int, error_rate: float,
+                 slow_call_seconds: float, slow_call_rate: float, open_seconds: float):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._outcomes: deque = deque()  # (timestamp, failed, slow)
+        self._lock = threading.Lock()
+        self.last_error: Optional[str] = None
+
+    def _prune(self, now: float):
+        while self._outcomes and self._outcomes[0][0] <= now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def _open(self, now: float, reason: str):
+        self.state = "open"
+        self._opened_at = now
+        self._probe_in_flight = False
+        logger.warning(f"Circuit breaker for {self.name} opened: {reason}")
+
+    def _cooled_down(self, now: float) -> bool:
+        return self.state == "open" and now >= self._opened_at + self.open_seconds
+
+    def is_available(self) -> bool:
+        """Whether a call would currently be allowed, without using up the half-open probe"""
+        with self._lock:
+            if self.state == "closed" or self._cooled_down(time.monotonic()):
+                return True
+            return self.state == "half_open" and not self._probe_in_flight
+
+    def allow(self) -> bool:
+        """Reserves permission for one call; in half-open state only a single probe is allowed"""
+        with self._lock:
+            if self._cooled_down(time.monotonic()):
+                self.state = "half_open"
+                logger.info(f"Circuit breaker for {self.name} half-open, probing")
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record(self, failed: bool, latency: float, error: Optional[Exception] = None):
+        """Records the outcome of an allowed call and updates the state"""
+        now = time.monotonic()
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            if error is not None:
+                self.last_error = str(error)[:200]
+
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if failed or slow:
+                    self._open(now, "probe call failed")
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    logger.info(f"Circuit breaker for {self.name} closed, dependency recovered")
+                return
+
+            self._outcomes.append((now, failed, slow))
+            self._prune(now)
+            calls = len(self._outcomes)
+            if self.state != "closed" or calls < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, _, s in self._outcomes if s)
+            if failures / calls >= self.error_rate:
+                self._open(now, f"{failures}/{calls} calls failed")
+            elif slow_calls / calls >= self.slow_call_rate:
+                self._open(now, f"{slow_calls}/{calls} calls slower than {self.slow_call_seconds}s")
+
+    def call(self, func, *args, **kwargs):
+        """Calls func through the breaker, raising CircuitOpenError without calling it while open"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is temporarily unavailable")
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record(is_dependency_failure(e), time.perf_counter() - start, e)
+            raise
+        self.record(False, time.perf_counter() - start)
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        """Current state and rolling-window stats for the health surface"""
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            calls = len(self._outcomes)
+            return {
+                "state": "half_open" if self._cooled_down(now) else self.state,
+                "calls_in_window": calls,
+                "error_rate": round(sum(1 for _, f, _ in self._outcomes if f) / calls, 2) if calls else 0.0,
+                "slow_rate": round(sum(1 for _, _, s in self._outcomes if s) / calls, 2) if calls else 0.0,
+                "retry_in_seconds": round(max(0.0, self._opened_at + self.open_seconds - now), 1) if self.state == "open" else 0.0,
+                "last_error": self.last_error,
+            }
+
+
+@st.cache_resource
+def get_circuit_breakers() -> Dict[str, CircuitBreaker]:
+    """
+    One circuit breaker per outbound dependency, shared by all sessions.
+    Settings come from the `resilience` section of config/prompts.yaml.
+    """
+    resilience_config = get_active_config().get('resilience', {})
+    return {
+        name: CircuitBreaker(name, **{**defaults, **resilience_config.get(name, {})})
+        for name, defaults in DEFAULT_RESILIENCE_CONFIG.items()
+    }
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Circuit breaker for one dependency: gemini, duckduckgo or firestore"""
+    return get_circuit_breakers()[name]
+
+
+def get_health_status() -> Dict[str, Any]:
+    """Dependency health, admission and memory metrics and queued writes for the status page"""
+    return {
+        "dependencies": {name: breaker.status() for name, breaker in get_circuit_breakers().items()},
+        "admission": get_admission_controller(get_active_config().get('admission')).get_metrics(),
+        "queued_waitlist_writes": len(get_waitlist_queue()),
+        "memory": get_memory_governor().get_metrics(),
+    }
+
+
 def has_firebase_secrets() -> bool:
     """Quick check if Firebase secrets are configured without accessing them."""
     try:
@@ -81,61 +375,166 @@ def get_firestore_key_path() -> Optional[str]:
 
 
 @st.cache_resource
-def get_firestore_client() -> Optional[firestore.Client]:
+def _create_firestore_client() -> firestore.Client:
     """
     Creates a Firestore client using credentials from st.secrets.
-    Returns None if credentials are not configured.
-    Uses Streamlit caching to avoid recreating client on every call.
+    Uses Streamlit caching so the client is only built once; failures raise
+    and are not cached, so a later call can retry.
     """
-    try:
-        if not has_firebase_secrets():
-            return None
+    # Create credentials from the secrets dictionary
+    firebase_secrets = dict(st.secrets["firebase"])
+    creds = service_account.Credentials.from_service_account_info(firebase_secrets)
 
-        # Create credentials from the secrets dictionary
-        firebase_secrets = dict(st.secrets["firebase"])
-        creds = service_account.Credentials.from_service_account_info(firebase_secrets)
+    # Create and return the Firestore client
+    db = firestore.Client(credentials=creds, project=firebase_secrets.get("project_id"))
+    logger.info("Firestore client created and cached")
+    return db
+
+
+def get_firestore_client() -> Optional[firestore.Client]:
+    """
+    Returns the cached Firestore client, or None if credentials are not configured,
+    the client can't be created, or Firestore's circuit breaker is open.
+    """
+    if not has_firebase_secrets():
+        return None
 
-        # Create and return the Firestore client
-        db = firestore.Client(credentials=creds, project=firebase_secrets.get("project_id"))
-        logger.info("Firestore client created and cached")
-        return db
+    breaker = get_circuit_breaker("firestore")
+    if not breaker.is_available():
+        return None
 
+    try:
+        return _create_firestore_client()
     except Exception as e:
         logger.error(f"Error creating Firestore client: {str(e)}")
+        # Bad credentials (ValueError etc.) are our problem, not an outage, so they don't open the breaker
+        if breaker.allow():
+            breaker.record(is_dependency_failure(e), 0.0, e)
         return None
 
 
+def _write_subscriber(db: firestore.Client, email: str):
+    """Writes one subscriber document through Firestore's circuit breaker"""
+    doc_ref = db.collection("subscribers").document()
+    get_circuit_breaker("firestore").call(doc_ref.set, {
+        "email": email,
+        "subscribed_at": firestore.SERVER_TIMESTAMP,
+        "source": "breakup_recovery_app"
+    })
+
+
+class WaitlistQueue:
+    """
+    Waitlist signups accepted while Firestore is unhealthy, written once it recovers.
+    Mirrored to a JSON file so a process restart doesn't lose them.
+    Past max_size the oldest signup is dropped (and logged).
+    """
+
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._emails: deque = deque()
+        try:
+            self._emails.extend(json.loads(path.read_text(encoding="utf-8"))[-max_size:])
+            logger.info(f"Loaded {len(self._emails)} queued waitlist signups from {path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Could not read queued waitlist signups from {path}: {str(e)}")
+
+    def __len__(self) -> int:
+        return len(self._emails)
+
+    def _persist(self):
+        """Rewrites the file from the in-memory queue (lock must be held)"""
+        try:
+            self.path.write_text(json.dumps(list(self._emails)), encoding="utf-8")
+        except Exception as e:
+            logger.error(f"Could not persist queued waitlist signups: {str(e)}")
+
+    def append(self, email: str):
+        with self._lock:
+            if len(self._emails) >= self.max_size:
+                dropped = self._emails.popleft()
+                logger.error(f"Waitlist queue full ({self.max_size}), dropped oldest queued signup: {dropped}")
+            self._emails.append(email)
+            self._persist()
+            logger.warning(f"Firestore unavailable, queued waitlist signup ({len(self._emails)} queued)")
+
+    def flush(self, db: firestore.Client):
+        """Writes queued signups in order, stopping at the first failure. Only one flush runs at a time."""
+        if not self._flushing.acquire(blocking=False):
+            return
+        try:
+            while self._emails:
+                email = self._emails[0]
+                try:
+                    _write_subscriber(db, email)
+                except Exception as e:
+                    logger.error(f"Error flushing queued waitlist signups: {str(e)}")
+                    return
+                with self._lock:
+                    self._emails.popleft()
+                    self._persist()
+                logger.info(f"Queued email saved to Firestore: {email}")
+        finally:
+            self._flushing.release()
+
+
+@st.cache_resource(show_spinner=False)
+def get_waitlist_queue() -> WaitlistQueue:
+    """
+    Process-wide queue of pending waitlist signups.
+    Uses Streamlit caching because module globals are re-created on every rerun.
+    """
+    return WaitlistQueue(WAITLIST_QUEUE_PATH, MAX_QUEUED_WAITLIST_WRITES)
+
+
+def schedule_waitlist_flush():
+    """
+    Writes queued signups in the background once Firestore's breaker lets calls through again.
+    Called on every page load, so the queue drains shortly after Firestore recovers.
+    """
+    queue = get_waitlist_queue()
+    if not len(queue) or not has_firebase_secrets() or not get_circuit_breaker("firestore").is_available():
+        return
+    db = get_firestore_client()
+    if db is not None:
+        threading.Thread(target=queue.flush, args=(db,), name="waitlist-flush", daemon=True).start()
+
+
 def save_email_to_firestore(email: str) -> bool:
     """
     Saves an email address to the Firestore 'subscribers' collection.
-    Returns True if successful, False otherwise.
+    While Firestore is unavailable, valid emails are queued in memory and written later.
+    Returns True if saved or queued, False if the email is invalid or Firestore isn't configured.
     """
-    try:
-        db = get_firestore_client()
-        if db is None:
-            logger.error("Could not connect to Firestore")
-            return False
-
-        # Validate email format
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
-            logger.warning(f"Invalid email format: {email}")
-            return False
+    # Validate email format
+    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    if not re.match(email_pattern, email):
+        logger.warning(f"Invalid email format: {email}")
+        return False
 
-        # Save to Firestore with server timestamp
-        doc_ref = db.collection("subscribers").document()
-        doc_ref.set({
-            "email": email.lower().strip(),
-            "subscribed_at": firestore.SERVER_TIMESTAMP,
-            "source": "breakup_recovery_app"
-        })
+    if not has_firebase_secrets():
+        logger.error("Could not connect to Firestore")
+        return False
 
-        logger.info(f"Email saved to Firestore: {email}")
+    email = email.lower().strip()
+    queue = get_waitlist_queue()
+    db = get_firestore_client()
+    if db is None:
+        queue.append(email)
         return True
 
+    try:
+        _write_subscriber(db, email)
+        logger.info(f"Email saved to Firestore: {email}")
     except Exception as e:
-        logger.error(f"Error saving email to Firestore: {str(e)}")
-        return False
+        logger.error(f"Error saving email to Firestore, queued for retry: {str(e)}")
+        queue.append(email)
+    return True
 
 
 def cleanup_firestore_temp_file():
@@ -154,8 +553,9 @@ def cleanup_firestore_temp_file():
 atexit.register(cleanup_firestore_temp_file)
 
 
+@st.cache_data
 def get_social_urls() -> Dict[str, str]:
-    """Get social media URLs from environment variables"""
+    """Get social media URLs from environment variables (read once per process)"""
     return {
         "linkedin": env_config("LINKEDIN_URL", default=""),
         "website": env_config("WEBSITE_URL", default=""),
@@ -348,11 +748,12 @@ CURATED_SONGS = {
 ERA_IDS = ["viral_now", "gen_z", "streaming_era", "classics"]
 
 
-def get_music_recommendations_text() -> str:
+def get_music_recommendations_text(era_count: int = len(ERA_IDS)) -> str:
     """
     Get formatted music recommendations text for LLM context.
     Selects one song from each era per category for balanced variety across time periods.
     Total: 4 songs per category (one from each era) = 12 songs total.
+    era_count < 4 keeps only the most recent eras (used when trimming to a token budget).
     """
     text = "**Curated Song Recommendations for Breakup Recovery:**\n\n"
 
@@ -363,7 +764,7 @@ def get_music_recommendations_text() -> str:
         text += f"*{category['description']}*\n\n"
 
         # Select one random song from each era
-        for era_id in ERA_IDS:
+        for era_id in ERA_IDS[:era_count]:
             era_songs = category["eras"][era_id]["songs"]
             selected_song = random.choice(era_songs)
             text += f"- **\"{selected_song['title']}\"** by {selected_song['artist']} ({selected_song['tag']})\n"
@@ -373,22 +774,13 @@ def get_music_recommendations_text() -> str:
     text += "*Note: These songs span different eras. Personalize based on user's situation and music preferences.*"
     return text
 
-def cleanup_temp_files():
-    """Clean up all temporary files created during the session"""
-    for temp_path in temp_files_created:
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"Cleaned up temporary file: {temp_path}")
-        except Exception as e:
-            logger.error(f"Error cleaning up {temp_path}: {str(e)}")
-    temp_files_created.clear()
-
-# Register cleanup function to run on exit
-atexit.register(cleanup_temp_files)
-
+@st.cache_resource(show_spinner=False)
 def load_config() -> Dict[str, Any]:
-    """Load configuration from YAML file"""
+    """
+    Load configuration from YAML file.
+    Uses Streamlit caching so the YAML is parsed once per process, not on every rerun.
+    No spinner: a cache miss runs before st.set_page_config, which must be the first element.
+    """
     try:
         with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
             config = yaml.safe_load(f)
@@ -399,6 +791,16 @@ def load_config() -> Dict[str, Any]:
         st.error(f"Failed to load configuration file. Please check {CONFIG_PATH}")
         st.stop()
 
+
+# Config passed to the CLI with --config; the Streamlit app always uses CONFIG_PATH
+_cli_config: Optional[Dict[str, Any]] = None
+
+
+def get_active_config() -> Dict[str, Any]:
+    """Config for the process-wide singletons (breakers, memory governor): --config in the CLI, else CONFIG_PATH"""
+    return _cli_config if _cli_config is not None else load_config()
+
+
 def get_default_api_key() -> Optional[str]:
     """Get default API key from environment variables"""
     try:
@@ -422,203 +824,1652 @@ def validate_input(text: str, max_length: int = MAX_INPUT_LENGTH) -> bool:
     """Validate user input length"""
     return len(text) <= max_length
 
-def validate_file_size(file) -> bool:
-    """Validate uploaded file size"""
-    try:
-        file_size = len(file.getvalue())
-        return file_size <= MAX_FILE_SIZE
-    except:
-        return False
+# Fallback scanner patterns if config/prompts.yaml has no `safety` section
+DEFAULT_SAFETY_CONFIG = {
+    "neutralize": ["control_character"],
+    "input_patterns": {
+        "code_injection": ["```", "<script", "javascript:", "eval(", "exec("],
+    },
+}
 
-def sanitize_input(text: str) -> str:
-    """Basic input sanitization to prevent injection"""
-    # Remove any potential code injection attempts
-    dangerous_patterns = ['```', '<script>', 'javascript:', 'eval(', 'exec(']
-    sanitized = text
-    for pattern in dangerous_patterns:
-        if pattern.lower() in sanitized.lower():
-            logger.warning(f"Potentially dangerous pattern detected: {pattern}")
-    return sanitized
-
-def initialize_agents(api_key: str, config: Dict[str, Any]) -> tuple[Optional[Agent], Optional[Agent], Optional[Agent], Optional[Agent]]:
-    """Initialize all AI agents with configuration"""
-    try:
-        # Get model configuration from environment variables (with YAML fallback)
-        model_config = get_model_config(config)
-        model = Gemini(id=model_config['id'], api_key=api_key)
+# Invisible/formatting characters that can hide instructions from a human reader.
+# ZWNJ/ZWJ (U+200C/U+200D) are left alone: emoji sequences and Indic/Persian text need them.
+CONTROL_CHARACTERS = "[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\u200b\u200e\u200f\u202a-\u202e\u2060-\u2064\u2066-\u2069\ufeff]"
+NEUTRALIZED_PLACEHOLDER = "[filtered]"
 
-        agents_config = config['agents']
 
-        therapist_agent = Agent(
-            model=model,
-            name=agents_config['therapist']['name'],
-            instructions=agents_config['therapist']['instructions'],
-            markdown=True
-        )
+def _build_trie_pattern(phrases: List[str]) -> str:
+    """
+    Builds a regex from a character trie of the phrases, so shared prefixes are
+    matched once instead of trying every alternative at every position.
+    Spaces inside a phrase match any run of whitespace.
+    """
+    trie: Dict[str, Any] = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = True
 
-        closure_agent = Agent(
-            model=model,
-            name=agents_config['closure']['name'],
-            instructions=agents_config['closure']['instructions'],
-            markdown=True
-        )
+    def emit(node: Dict[str, Any]) -> str:
+        branches = []
+        for char in sorted(key for key in node if key):
+            token = r"\s+" if char == " " else re.escape(char)
+            branches.append(token + emit(node[char]))
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Greedy optional tail keeps the longest phrase when one is a prefix of another
+        return f"(?:{body})?" if "" in node else body
 
-        # Get curated music recommendations for Jonas (routine planner)
-        # Uses era-based selection: one song from each era per category (12 songs total)
-        music_recommendations = get_music_recommendations_text()
+    return emit(trie)
 
-        # Add music recommendations context to Jonas's instructions
-        jonas_instructions = agents_config['routine_planner']['instructions']
-        jonas_instructions = f"{jonas_instructions}\n\n## 🎵 Curated Music Recommendations\n\n{music_recommendations}"
-        logger.info("Added curated music recommendations to Jonas agent")
 
-        routine_planner_agent = Agent(
-            model=model,
-            name=agents_config['routine_planner']['name'],
-            instructions=jonas_instructions,
-            markdown=True
-        )
+def _normalize_phrase(text: str) -> str:
+    """Lowercase and collapse whitespace so matches map back to their configured phrase"""
+    return " ".join(text.lower().split())
 
-        brutal_honesty_agent = Agent(
-            model=model,
-            name=agents_config['brutal_honesty']['name'],
-            tools=[DuckDuckGoTools()],
-            instructions=agents_config['brutal_honesty']['instructions'],
-            markdown=True
-        )
 
-        logger.info("All agents initialized successfully")
-        return therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent
+@st.cache_resource
+def get_input_scanner(safety_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Compiles all configured input patterns into one single-pass regex.
+    Phrases starting with a letter or digit only match at a word start, which keeps
+    the scan sub-millisecond at MAX_INPUT_LENGTH even with hundreds of patterns.
+    Uses Streamlit caching so the regex is compiled once per config.
+    """
+    safety_config = safety_config or DEFAULT_SAFETY_CONFIG
+
+    categories: Dict[str, str] = {}
+    for category, phrases in safety_config.get("input_patterns", {}).items():
+        for phrase in phrases or []:
+            normalized = _normalize_phrase(str(phrase))
+            if normalized:
+                categories.setdefault(normalized, category)
+
+    word_phrases = [phrase for phrase in categories if phrase[0].isalnum()]
+    symbol_phrases = [phrase for phrase in categories if not phrase[0].isalnum()]
+
+    alternatives = []
+    if word_phrases:
+        alternatives.append(f"(?P<word>(?<![a-z0-9]){_build_trie_pattern(word_phrases)})")
+    if symbol_phrases:
+        alternatives.append(f"(?P<symbol>{_build_trie_pattern(symbol_phrases)})")
+    alternatives.append(f"(?P<control>{CONTROL_CHARACTERS})")
+
+    combined = "|".join(alternatives)
+    logger.info(f"Input scanner compiled with {len(categories)} patterns")
+    return {
+        # Case-sensitive matching on pre-lowercased text is ~3x faster than re.IGNORECASE
+        "regex": re.compile(combined),
+        "regex_ignorecase": re.compile(combined, re.IGNORECASE),
+        "categories": categories,
+        "neutralize": set(safety_config.get("neutralize", [])),
+    }
 
-    except Exception as e:
-        error_str = str(e).lower()
-        logger.error(f"Error initializing agents: {str(e)}")
 
-        # User-friendly error messages based on error type
-        if "quota" in error_str or "quota exceeded" in error_str:
-            st.error("⚠️ We're experiencing high demand! API quota exceeded. Please try again later.")
-        elif "rate limit" in error_str or "429" in error_str:
-            st.error("⏳ Too many requests right now. Please wait a moment and try again.")
-        elif "503" in error_str or "service unavailable" in error_str:
-            st.error("🔧 Service temporarily unavailable. Please try again in a few minutes.")
+def scan_input(text: str, scanner: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Scans text in a single pass and returns one finding per match:
+    {"category", "pattern", "start", "end"}
+    Without a scanner, uses the `safety` section of the active config (like sanitize_input).
+    """
+    scanner = scanner or get_input_scanner(get_active_config().get('safety'))
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        matches = scanner["regex"].finditer(lowered)
+    else:
+        # A few characters change length when lowercased, which would shift offsets
+        matches = scanner["regex_ignorecase"].finditer(text)
+
+    findings = []
+    for match in matches:
+        if match.lastgroup == "control":
+            category, pattern = "control_character", f"U+{ord(match.group()):04X}"
         else:
-            st.error("Our service is temporarily unavailable. Please try again in a few minutes.")
+            pattern = _normalize_phrase(match.group())
+            category = scanner["categories"].get(pattern, "unknown")
+        findings.append({
+            "category": category,
+            "pattern": pattern,
+            "start": match.start(),
+            "end": match.end(),
+        })
+    return findings
 
-        return None, None, None, None
 
-def process_images(files) -> List[AgnoImage]:
-    """Process uploaded image files and return Agno Image objects"""
-    processed_images = []
-    for file in files:
-        try:
-            # Validate file size
-            if not validate_file_size(file):
-                st.warning(f"File {file.name} exceeds maximum size of 10MB and will be skipped")
-                continue
+def neutralize_input(text: str, findings: List[Dict[str, Any]], categories: set) -> str:
+    """Removes control characters and replaces other matches in the given categories"""
+    parts = []
+    position = 0
+    for finding in findings:
+        if finding["category"] not in categories:
+            continue
+        parts.append(text[position:finding["start"]])
+        if finding["category"] != "control_character":
+            parts.append(NEUTRALIZED_PLACEHOLDER)
+        position = finding["end"]
+    parts.append(text[position:])
+    return "".join(parts)
 
-            temp_dir = tempfile.gettempdir()
-            temp_path = os.path.join(temp_dir, f"temp_{file.name}")
 
-            with open(temp_path, "wb") as f:
-                f.write(file.getvalue())
+def sanitize_input(text: str, safety_config: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Scan user input for code injection, prompt injection and hidden control characters.
+    Findings are logged; categories listed under `safety.neutralize` are neutralized.
+    """
+    scanner = get_input_scanner(safety_config)
+    findings = scan_input(text, scanner)
+    if not findings:
+        return text
 
-            # Track temp file for cleanup
-            temp_files_created.append(temp_path)
+    summary: Dict[str, int] = {}
+    for finding in findings:
+        summary[finding["category"]] = summary.get(finding["category"], 0) + 1
+    logger.warning(f"Potentially dangerous input patterns detected: {summary}")
 
-            agno_image = AgnoImage(filepath=Path(temp_path))
-            processed_images.append(agno_image)
-            logger.info(f"Processed image: {file.name}")
+    return neutralize_input(text, findings, scanner["neutralize"])
 
-        except Exception as e:
-            logger.error(f"Error processing image {file.name}: {str(e)}")
-            st.warning(f"Could not process image {file.name}")
-            continue
 
-    return processed_images
+def benchmark_input_scanner(pattern_count: int = 300, iterations: int = 200) -> Dict[str, float]:
+    """
+    Micro-benchmark for the input scanner at MAX_INPUT_LENGTH.
+    Uses synthetic phrases on top of the configured ones and a realistic story-like input.
+    """
 
-def main():
-    """Main application entry point"""
+    rng = random.Random(42)
+    words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(4, 9))) for _ in range(1000)]
+    safety_config = json.loads(json.dumps(DEFAULT_SAFETY_CONFIG))
+    safety_config["input_patterns"]["synthetic"] = [" ".join(rng.sample(words, 3)) for _ in range(pattern_count)]
+
+    story = ("We were together for three years and I still can't believe they left without a real explanation. "
+             "I keep rereading our old chats at night. ")
+    text = (story * (MAX_INPUT_LENGTH // len(story) + 1))[:MAX_INPUT_LENGTH]
+
+    scanner = get_input_scanner(safety_config)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        scan_input(text, scanner)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    results = {
+        "patterns": float(len(scanner["categories"])),
+        "text_length": float(len(text)),
+        "median_ms": timings[len(timings) // 2],
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+    }
+    logger.info(f"Input scanner benchmark: {results}")
+    return results
 
-    # Load configuration
-    config = load_config()
-    ui_config = config['ui']
-    agents_config = config['agents']
+# Words that, right before a crisis phrase, usually mean the user is ruling it out
+CRISIS_NEGATION = re.compile(r"\b(?:not|never|no|don't|dont|won't|wont|wouldn't|wouldnt)\b")
 
-    # Set page config
-    st.set_page_config(
-        page_title=ui_config['app_title'],
-        page_icon=ui_config['page_icon'],
-        layout="wide"
-    )
 
-    # Hide Streamlit branding (keep menu for user features like Print)
-    # Using !important to override Streamlit Cloud's injected styles
-    hide_streamlit_style = """
-        <style>
-        /* 1. Remove the "Deploy" button */
-        .stDeployButton {
-            display: none !important;
-        }
-        
-        /* 2. Remove the "Fork this app" / GitHub Ribbon / Toolbar */
-        [data-testid="stToolbar"] {
-            display: none !important;
-        }
-        
-        /* 3. Remove the Footer */
-        footer {
-            display: none !important;
-        }
-        
-        /* 4. Remove decoration and status widgets */
-        div[data-testid="stDecoration"] {
-            display: none !important;
-        }
-        div[data-testid="stStatusWidget"] {
-            display: none !important;
-        }
-        
-        /* 5. Hide header branding elements but keep menu button visible */
-        /* Hide the header container's content (logo, title, etc.) */
-        header[data-testid="stHeader"] > div:first-child,
-        header[data-testid="stHeader"] > div:nth-child(2) {
-            display: none !important;
-        }
-        
-        /* 6. Explicitly show hamburger menu - multiple selectors for compatibility */
-        #MainMenu {
-            display: block !important;
-            visibility: visible !important;
-            opacity: 1 !important;
-        }
-        button[kind="header"],
-        button[data-testid="baseButton-header"],
-        header button[aria-label*="menu"],
-        header button[aria-label*="Menu"] {
-            display: block !important;
-            visibility: visible !important;
-            opacity: 1 !important;
+@st.cache_resource
+def get_crisis_classifier(crisis_config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compiles the weighted crisis phrases from config into one single-pass regex.
+    Uses Streamlit caching so the regex is compiled once per config.
+    """
+    weights: Dict[str, float] = {}
+    required_group = crisis_config.get("required_group")
+    required = set()
+    for group_name, group in crisis_config.get("phrases", {}).items():
+        for phrase in group.get("patterns", []):
+            normalized = _normalize_phrase(str(phrase))
+            if normalized:
+                weights[normalized] = max(weights.get(normalized, 0.0), float(group["weight"]))
+                if group_name == required_group:
+                    required.add(normalized)
+
+    logger.info(f"Crisis classifier compiled with {len(weights)} phrases")
+    return {
+        # Whole words only, so "bridge" doesn't match "Bridget"
+        "regex": re.compile(f"(?<![a-z0-9]){_build_trie_pattern(list(weights))}(?![a-z0-9])"),
+        "weights": weights,
+        # Phrases of which at least one must match un-negated for the text to be flagged (all if no required_group)
+        "required": required if required_group else set(weights),
+        "threshold": float(crisis_config.get("threshold", 3.0)),
+        "negation_factor": float(crisis_config.get("negation_factor", 0.25)),
+    }
+
+
+def classify_crisis(text: str, crisis_config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Cheap local crisis triage on the user's text, run before any model call.
+    Sums the weights of the distinct matched phrases (discounted when negated just
+    before; a phrase repeated through a long story counts once, at its highest weight)
+    and returns {"is_crisis", "show_resources", "score", "matches"}. Only text with an
+    un-negated phrase from crisis.required_group is flagged as a crisis; text that reaches
+    the threshold on weaker phrases alone gets the helplines next to the normal plan.
+    """
+    if not crisis_config or not text:
+        return {"is_crisis": False, "show_resources": False, "score": 0.0, "matches": []}
+
+    classifier = get_crisis_classifier(crisis_config)
+    lowered = text.lower()
+    phrase_weights: Dict[str, float] = {}
+    anchored = False
+    for match in classifier["regex"].finditer(lowered):
+        phrase = _normalize_phrase(match.group())
+        weight = classifier["weights"].get(phrase, 0.0)
+        # Only look two words back, so "can't stop thinking about ending it" still counts
+        preceding = " ".join(lowered[max(0, match.start() - 40):match.start()].split()[-2:])
+        if CRISIS_NEGATION.search(preceding):
+            weight *= classifier["negation_factor"]
+        elif phrase in classifier["required"]:
+            anchored = True
+        phrase_weights[phrase] = max(phrase_weights.get(phrase, 0.0), weight)
+
+    score = sum(phrase_weights.values())
+    matches = list(phrase_weights)
+    over_threshold = score >= classifier["threshold"]
+    return {"is_crisis": anchored and over_threshold, "show_resources": over_threshold, "score": score, "matches": matches}
+
+
+def evaluate_crisis_classifier(crisis_config: Dict[str, Any], eval_path: Path = CRISIS_EVAL_PATH) -> Dict[str, float]:
+    """
+    Precision, recall and latency of the crisis classifier on the labeled offline set.
+    Each line of the JSONL file is {"text": ..., "label": 0 or 1}.
+    """
+    with open(eval_path, "r", encoding="utf-8") as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+
+    counts = {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+    timings = []
+    for example in examples:
+        start = time.perf_counter()
+        predicted = classify_crisis(example["text"], crisis_config)["is_crisis"]
+        timings.append((time.perf_counter() - start) * 1000)
+
+        if predicted and example["label"]:
+            counts["tp"] += 1
+        elif predicted:
+            counts["fp"] += 1
+            logger.info(f"Crisis false positive: {example['text']}")
+        elif example["label"]:
+            counts["fn"] += 1
+            logger.info(f"Crisis false negative: {example['text']}")
+        else:
+            counts["tn"] += 1
+
+    timings.sort()
+    results = {
+        "examples": float(len(examples)),
+        "precision": counts["tp"] / max(1, counts["tp"] + counts["fp"]),
+        "recall": counts["tp"] / max(1, counts["tp"] + counts["fn"]),
+        **{key: float(value) for key, value in counts.items()},
+        "median_ms": timings[len(timings) // 2] if timings else 0.0,
+    }
+    logger.info(f"Crisis classifier evaluation: {results}")
+    return results
+
+
+def benchmark_crisis_classifier(crisis_config: Dict[str, Any], iterations: int = 200) -> Dict[str, float]:
+    """Micro-benchmark for the crisis classifier at MAX_INPUT_LENGTH"""
+    story = ("We were together for three years and I still can't believe they left without a real explanation. "
+             "I keep rereading our old chats at night and I feel so hopeless. ")
+    text = (story * (MAX_INPUT_LENGTH // len(story) + 1))[:MAX_INPUT_LENGTH]
+
+    get_crisis_classifier(crisis_config)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        classify_crisis(text, crisis_config)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    results = {
+        "text_length": float(len(text)),
+        "median_ms": timings[len(timings) // 2],
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+    }
+    logger.info(f"Crisis classifier benchmark: {results}")
+    return results
+
+
+def render_crisis_resources(crisis_config: Dict[str, Any]):
+    """Crisis helplines, rendered locally with no model call, admission or rate limit"""
+    st.markdown(f"""<div style="border-left: 4px solid {AGENT_COLORS['therapist']}; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
+    st.subheader(crisis_config['resources_title'])
+    st.markdown(crisis_config['resources'])
+    st.markdown("</div>", unsafe_allow_html=True)
+
+
+def render_crisis_response(config: Dict[str, Any], final_api_key: Optional[str], sanitized_input: str, scope: str = "plan"):
+    """
+    Shows crisis resources right away, then a single gentle response from Maya
+    instead of the full four-agent plan. Maya's call goes through admission control
+    (the plan or chat windows, per scope) like any other; when it is rejected only
+    the resources are shown.
+    """
+    render_crisis_resources(config['crisis'])
+
+    if not final_api_key:
+        return
+
+    controller = get_admission_controller(config.get('admission'))
+    client_address = get_client_address(controller.config["trusted_proxies"])
+    admitted, reason = controller.acquire(get_session_id(), client_address, scope=scope)
+    if not admitted:
+        logger.warning(f"Crisis response not generated ({reason}), showing resources only")
+        return
+
+    try:
+        model = Gemini(id=get_model_config(config)['id'], api_key=final_api_key)
+        agent = build_agent('therapist', model, config['agents'])
+        with st.spinner(config['ui']['loading_messages']['therapist']):
+            response = call_gemini(agent, config['crisis']['response_prompt'].format(user_input=sanitized_input))
+        st.subheader(config['ui']['section_titles']['therapist'])
+        st.markdown(response.content)
+    except Exception as e:
+        # The resources are already on screen, which matters most here
+        logger.error(f"Error generating crisis response: {str(e)}")
+    finally:
+        controller.release(client_address)
+
+
+def get_api_error_message(error: Exception, default: str) -> str:
+    """User-friendly error message based on error type and status code"""
+    if isinstance(error, CircuitOpenError):
+        return "🔧 Service temporarily unavailable. Please try again in a few minutes."
+
+    status_code = get_error_status_code(error)
+    error_str = str(error).lower()
+    if "quota" in error_str:
+        return "⚠️ We're experiencing high demand! API quota exceeded. Please try again later."
+    if status_code == 429 or "rate limit" in error_str:
+        return "⏳ Too many requests right now. Please wait a moment and try again."
+    if (status_code is not None and status_code >= 500) or "service unavailable" in error_str:
+        return "🔧 Service temporarily unavailable. Please try again in a few minutes."
+    return default
+
+
+def call_gemini(agent, prompt: str, images: Optional[List[AgnoImage]] = None):
+    """Runs an agent through Gemini's circuit breaker, failing fast while Gemini is unhealthy"""
+    return get_circuit_breaker("gemini").call(agent.run, prompt, images=images)
+
+
+def _search_tool_hook(function_name: str, function_call, arguments: Dict[str, Any]):
+    """
+    Agno tool hook that routes Riya's web searches through DuckDuckGo's circuit breaker.
+    Search failures become a note to the model instead of failing the whole response.
+    """
+    try:
+        return get_circuit_breaker("duckduckgo").call(function_call, **arguments)
+    except Exception as e:
+        logger.warning(f"Web search unavailable ({function_name}): {str(e)}")
+        return "Web search is temporarily unavailable. Answer from your own knowledge without searching."
+
+
+def build_agent(agent_key: str, model: Gemini, agents_config: Dict[str, Any], music_recommendations: Optional[str] = None) -> Agent:
+    """
+    Creates one squad agent; Jonas also gets the curated songs and Riya gets web search.
+    Pass music_recommendations to reuse a song block chosen by the token budget.
+    """
+    agent_config = agents_config[agent_key]
+    instructions = agent_config['instructions']
+    tools = None
+
+    if agent_key == 'routine_planner':
+        # Get curated music recommendations for Jonas (routine planner)
+        # Uses era-based selection: one song from each era per category (12 songs total)
+        music_recommendations = music_recommendations or get_music_recommendations_text()
+
+        # Add music recommendations context to Jonas's instructions
+        instructions = f"{instructions}\n\n## 🎵 Curated Music Recommendations\n\n{music_recommendations}"
+        logger.info("Added curated music recommendations to Jonas agent")
+
+    if agent_key == 'brutal_honesty':
+        if get_circuit_breaker("duckduckgo").is_available():
+            tools = [DuckDuckGoTools()]
+        else:
+            # Degrade gracefully: Riya answers without search while DuckDuckGo is down
+            instructions = [*instructions, "Web search is unavailable right now; rely on established relationship psychology."]
+            logger.info("DuckDuckGo circuit open, Riya running without search")
+
+    return Agent(
+        model=model,
+        name=agent_config['name'],
+        tools=tools,
+        tool_hooks=[_search_tool_hook] if tools else None,
+        instructions=instructions,
+        markdown=True
+    )
+
+
+def initialize_agents(api_key: str, config: Dict[str, Any], music_recommendations: Optional[str] = None) -> tuple[Optional[Agent], Optional[Agent], Optional[Agent], Optional[Agent]]:
+    """Initialize all AI agents with configuration"""
+    try:
+        # Get model configuration from environment variables (with YAML fallback)
+        model_config = get_model_config(config)
+        model = Gemini(id=model_config['id'], api_key=api_key)
+
+        agents_config = config['agents']
+
+        therapist_agent = build_agent('therapist', model, agents_config)
+        closure_agent = build_agent('closure', model, agents_config)
+        routine_planner_agent = build_agent('routine_planner', model, agents_config, music_recommendations)
+        brutal_honesty_agent = build_agent('brutal_honesty', model, agents_config)
+
+        logger.info("All agents initialized successfully")
+        return therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent
+
+    except Exception as e:
+        logger.error(f"Error initializing agents: {str(e)}")
+        st.error(get_api_error_message(e, "Our service is temporarily unavailable. Please try again in a few minutes."))
+
+        return None, None, None, None
+
+# Order the squad responds in, and each agent's border color in the UI
+AGENT_ORDER = ['therapist', 'closure', 'routine_planner', 'brutal_honesty']
+AGENT_COLORS = {
+    'therapist': '#4A90E2',  # Maya - blue
+    'closure': '#9B59B6',  # Harper - purple
+    'routine_planner': '#2ECC71',  # Jonas - green
+    'brutal_honesty': '#E74C3C',  # Riya - red
+}
+
+
+def run_agent(agent, prompt: str, images: List[AgnoImage], estimated_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Runs one agent and returns its reply with latency and token usage
+    (and the pre-dispatch estimate, so estimates can be checked against actual usage).
+    Shared by the Streamlit UI and batch mode, so it must not call any st.* functions.
+    """
+    start = time.perf_counter()
+    response = call_gemini(agent, prompt, images)
+    latency = time.perf_counter() - start
+
+    metrics = getattr(response, "metrics", None)
+    result = {
+        "name": agent.name,
+        "content": response.content or "",
+        "latency_s": round(latency, 3),
+        "estimated_input_tokens": estimated_tokens,
+        "input_tokens": getattr(metrics, "input_tokens", None),
+        "output_tokens": getattr(metrics, "output_tokens", None),
+    }
+    logger.info(
+        f"{agent.name} responded in {result['latency_s']}s "
+        f"(estimated_input_tokens={estimated_tokens}, input_tokens={result['input_tokens']}, "
+        f"output_tokens={result['output_tokens']})"
+    )
+    return result
+
+
+def prepare_image(name: str, data: bytes) -> Dict[str, Any]:
+    """
+    Validates, hashes and downscales a single screenshot into an in-memory AgnoImage.
+    Runs on the image preparation pool, so it must not call any st.* functions.
+    Raises ValueError with a user-facing message if the file can't be used.
+    """
+    if len(data) > MAX_FILE_SIZE:
+        raise ValueError(f"File {name} exceeds maximum size of 10MB and will be skipped")
+
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            img.verify()
+        # verify() leaves the image unusable, so reopen it for resizing
+        img = PILImage.open(io.BytesIO(data))
+    except Exception as e:
+        logger.error(f"Error processing image {name}: {str(e)}")
+        raise ValueError(f"Could not process image {name}")
+
+    # Keep PNG screenshots lossless so chat text stays legible
+    image_format = "png" if img.format == "PNG" else "jpeg"
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    if max(img.size) > MAX_IMAGE_DIMENSION:
+        original_size = len(data)
+        data = _downscale_image(img, image_format, MAX_IMAGE_DIMENSION)
+        logger.info(f"Downscaled image {name} from {original_size} to {len(data)} bytes")
+
+    logger.info(f"Prepared image: {name}")
+    return {
+        "name": name,
+        "sha256": sha256,
+        "dhash": _difference_hash(img),
+        "size": len(data),
+        "width": img.width,
+        "height": img.height,
+        "format": image_format,
+        "image": AgnoImage(content=data, format=image_format, mime_type=f"image/{image_format}"),
+    }
+
+
+def _downscale_image(img: PILImage.Image, image_format: str, max_dimension: int) -> bytes:
+    """Shrinks img in place to fit max_dimension and returns the re-encoded bytes"""
+    img.thumbnail((max_dimension, max_dimension))
+    buffer = io.BytesIO()
+    if image_format == "png":
+        img.save(buffer, format="PNG", optimize=True)
+    else:
+        img.convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _difference_hash(img: PILImage.Image) -> int:
+    """64-bit perceptual hash; near-identical screenshots differ in only a few bits"""
+    pixels = list(img.convert("L").resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+@st.cache_resource
+def get_image_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool shared by all sessions for preparing screenshots in the background.
+    Uses Streamlit caching so reruns don't spawn new pools.
+    """
+    return ThreadPoolExecutor(max_workers=IMAGE_PREP_WORKERS, thread_name_prefix="image-prep")
+
+
+def _upload_key(file) -> str:
+    """Stable identity for an uploaded file across reruns"""
+    return getattr(file, "file_id", None) or f"{file.name}:{file.size}"
+
+
+def schedule_image_preparation(files) -> Dict[str, Future]:
+    """
+    Starts background preparation for newly uploaded screenshots as soon as they
+    appear in the uploader, so the work is done while the user is still typing.
+    Jobs for files that were removed or replaced are cancelled and evicted.
+    """
+    jobs: Dict[str, Future] = st.session_state.setdefault("image_jobs", {})
+    current = {_upload_key(file): file for file in files}
+
+    for key in list(jobs):
+        if key not in current:
+            jobs.pop(key).cancel()
+            logger.info(f"Evicted prepared image for removed upload: {key}")
+
+    executor = get_image_executor()
+    for key, file in current.items():
+        if key not in jobs:
+            jobs[key] = executor.submit(prepare_image, file.name, file.getvalue())
+
+    return jobs
+
+
+def release_prepared_images():
+    """Drop this session's prepared images once a submission no longer needs them"""
+    for job in st.session_state.pop("image_jobs", {}).values():
+        job.cancel()
+
+
+def collect_prepared_images(files) -> List[Dict[str, Any]]:
+    """
+    Collect the prepared images (see prepare_image) for the uploaded files.
+    Usually the background jobs have already finished; anything not yet
+    scheduled is started here and waited on. Duplicate screenshots are returned once.
+    """
+    jobs = schedule_image_preparation(files)
+    governor = get_memory_governor()
+    prepared_images = []
+    seen_hashes = set()
+
+    for file in files:
+        try:
+            prepared = jobs[_upload_key(file)].result(timeout=IMAGE_PREP_TIMEOUT)
+        except ValueError as e:
+            st.warning(str(e))
+            continue
+        except Exception as e:
+            logger.error(f"Error processing image {file.name}: {str(e)}")
+            st.warning(f"Could not process image {file.name}")
+            continue
+
+        # Replace the estimate made at upload time with the prepared copy's real size
+        reserved, reason = governor.reserve(get_session_id(), _upload_key(file), file.size + prepared["size"])
+        if not reserved:
+            st.warning(MEMORY_MESSAGES[reason])
+            continue
+
+        if prepared["sha256"] in seen_hashes:
+            logger.info(f"Skipping duplicate screenshot: {file.name}")
+            continue
+        seen_hashes.add(prepared["sha256"])
+        prepared_images.append(prepared)
+
+    return prepared_images
+
+
+def process_images(files) -> List[AgnoImage]:
+    """Collect the prepared Agno Image objects for the uploaded files"""
+    return [prepared["image"] for prepared in collect_prepared_images(files)]
+
+
+# Fallback memory ceilings if config/prompts.yaml has no `memory` section
+DEFAULT_MEMORY_CONFIG = {
+    "max_session_bytes": 60 * 1024 * 1024,
+    "max_process_bytes": 512 * 1024 * 1024,
+    "wait_seconds": 15,
+    "session_ttl_seconds": 1800,
+    "tracemalloc": False,
+}
+
+# Governor key for the prepared screenshots a plan keeps around for the chat
+CHAT_IMAGES_KEY = "chat_images"
+
+# User-facing messages for each memory rejection reason
+MEMORY_MESSAGES = {
+    "session": "Your screenshots are too large together. Please remove some or upload smaller images.",
+    "process": "We're handling a lot of screenshots right now. Please try again in a minute, or continue without screenshots.",
+}
+
+
+class MemoryGovernor:
+    """
+    Accounts for the bytes each session holds in uploads and prepared images, keyed by upload.
+    Reserving an upload again replaces its previous size.
+    - per-session ceiling: rejected straight away, waiting wouldn't help
+    - process-wide ceiling: waits up to wait_seconds for other sessions to release, then rejects
+    Streamlit has no session-end hook, so sessions idle past session_ttl_seconds are dropped.
+    """
+
+    def __init__(self, memory_config: Dict[str, Any]):
+        self.config = memory_config
+        self._condition = threading.Condition()
+        self._sessions: Dict[str, Dict[str, int]] = {}
+        self._last_seen: Dict[str, float] = {}
+        self._total = 0
+        self._peak = 0
+        self.metrics = {
+            "reserved": 0,
+            "waited": 0,
+            "rejected_session": 0,
+            "rejected_process": 0,
+            "expired_sessions": 0,
         }
-        
-        /* 7. Hide "View app source" button if present */
-        button[title="View app source"],
-        button[title="View the source code"] {
-            display: none !important;
+
+    def _count(self, metric: str):
+        self.metrics[metric] += 1
+        logger.warning(f"Upload rejected ({metric}), memory metrics: {self._snapshot()}")
+
+    def _expire_idle(self, now: float):
+        ttl = self.config["session_ttl_seconds"]
+        for session_id in [s for s, seen in self._last_seen.items() if now - seen > ttl]:
+            self._total -= sum(self._sessions.pop(session_id, {}).values())
+            del self._last_seen[session_id]
+            self.metrics["expired_sessions"] += 1
+
+    def _snapshot(self) -> Dict[str, int]:
+        return {
+            **self.metrics,
+            "in_use_bytes": self._total,
+            "peak_bytes": self._peak,
+            "sessions": len(self._sessions),
         }
-        
-        /* 8. Move the main content up so there is no white gap at the top */
-        .block-container {
-            padding-top: 1rem !important;
+
+    def touch(self, session_id: str):
+        """Marks a session that still holds reservations as alive, so it isn't expired while in use"""
+        with self._condition:
+            if session_id in self._sessions:
+                self._last_seen[session_id] = time.monotonic()
+
+    def held_keys(self, session_id: str) -> List[str]:
+        """Uploads this session currently holds a reservation for"""
+        with self._condition:
+            return list(self._sessions.get(session_id, {}))
+
+    def reserve(self, session_id: str, key: str, nbytes: int, on_wait=None, wait: bool = True) -> tuple[bool, Optional[str]]:
+        """
+        Blocks until nbytes can be held for key or the reservation is rejected.
+        Returns (reserved, reason) where reason is a key of MEMORY_MESSAGES.
+        on_wait is called once if the process is at its ceiling and the call has to wait.
+        With wait=False a process-ceiling rejection is immediate.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._expire_idle(now)
+            self._last_seen[session_id] = now
+            held = self._sessions.get(session_id, {})
+
+            if sum(held.values()) - held.get(key, 0) + nbytes > self.config["max_session_bytes"]:
+                self._count("rejected_session")
+                return False, "session"
+
+            deadline = now + (self.config["wait_seconds"] if wait else 0)
+            waited = False
+            while self._total - held.get(key, 0) + nbytes > self.config["max_process_bytes"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._count("rejected_process")
+                    return False, "process"
+                if not waited:
+                    waited = True
+                    self.metrics["waited"] += 1
+                    if on_wait:
+                        on_wait()
+                self._condition.wait(remaining)
+                held = self._sessions.get(session_id, {})
+
+            self._total += nbytes - held.get(key, 0)
+            self._sessions.setdefault(session_id, {})[key] = nbytes
+            self._peak = max(self._peak, self._total)
+            self.metrics["reserved"] += 1
+            return True, None
+
+    def release(self, session_id: str, keys: Optional[List[str]] = None):
+        """Frees the given uploads (all of them if keys is None) and wakes waiting sessions"""
+        with self._condition:
+            held = self._sessions.get(session_id, {})
+            for key in list(held) if keys is None else keys:
+                self._total -= held.pop(key, 0)
+            if not held:
+                self._sessions.pop(session_id, None)
+                self._last_seen.pop(session_id, None)
+            self._condition.notify_all()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Accounted bytes and counters, plus tracemalloc current/peak when tracing is on"""
+        with self._condition:
+            metrics: Dict[str, Any] = self._snapshot()
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            metrics["tracemalloc"] = {
+                "current_bytes": current,
+                "peak_bytes": peak,
+                "top_allocations": [str(stat) for stat in tracemalloc.take_snapshot().statistics("lineno")[:5]],
+            }
+        return metrics
+
+
+@st.cache_resource
+def get_memory_governor() -> MemoryGovernor:
+    """
+    Creates the process-wide memory governor from the `memory` section of config/prompts.yaml.
+    Uses Streamlit caching so all sessions share one account.
+    """
+    memory_config = {**DEFAULT_MEMORY_CONFIG, **(get_active_config().get('memory') or {})}
+    if memory_config["tracemalloc"] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        logger.info("tracemalloc started for memory diagnostics")
+    return MemoryGovernor(memory_config)
+
+
+def reserve_upload_memory(files) -> list:
+    """
+    Accounts for each upload's buffer plus its prepared copy (assumed the same size
+    until preparation finishes) and returns the uploads that fit.
+    Reservations for uploads no longer in the uploader are released first.
+    Waiting for the process ceiling happens at most once per upload: rejected uploads are
+    remembered and only retried without waiting on later reruns, and after one rejection
+    the rest of the batch doesn't wait either.
+    """
+    governor = get_memory_governor()
+    session_id = get_session_id()
+    governor.touch(session_id)
+    current = {_upload_key(file) for file in files}
+    governor.release(
+        session_id,
+        [key for key in governor.held_keys(session_id) if key not in current and key != CHAT_IMAGES_KEY]
+    )
+
+    rejected: Dict[str, str] = st.session_state.setdefault("memory_rejected_uploads", {})
+    for key in list(rejected):
+        if key not in current:
+            del rejected[key]
+
+    accepted = []
+    may_wait = True
+    for file in files:
+        key = _upload_key(file)
+        job = st.session_state.get("image_jobs", {}).get(key)
+        prepared_size = file.size
+        if job is not None and job.done() and not job.cancelled() and job.exception() is None:
+            prepared_size = job.result()["size"]
+        reserved, reason = governor.reserve(
+            session_id,
+            key,
+            file.size + prepared_size,
+            on_wait=lambda: st.info("⏳ Lots of screenshots are being processed right now, hang tight..."),
+            wait=may_wait and key not in rejected,
+        )
+        if reserved:
+            rejected.pop(key, None)
+            accepted.append(file)
+        else:
+            rejected[key] = reason
+            may_wait = False
+
+    if rejected:
+        st.warning(MEMORY_MESSAGES[next(iter(rejected.values()))])
+    return accepted
+
+
+def get_uploader_key() -> str:
+    """Widget key of the screenshot uploader; changes after each submission to empty it"""
+    return f"screenshots_{st.session_state.get('uploader_generation', 0)}"
+
+
+def get_reserved_uploads() -> list:
+    """Current uploads that were accepted by reserve_upload_memory"""
+    held = set(get_memory_governor().held_keys(get_session_id()))
+    files = (st.session_state.get(get_uploader_key()) or [])[:MAX_FILES]
+    return [file for file in files if _upload_key(file) in held]
+
+
+def release_upload_memory(keep_for_chat: Optional[List[Dict[str, Any]]] = None):
+    """
+    Frees everything this session holds once a submission completes: prepared images,
+    their memory reservations, and (on the next rerun) the uploader's own buffers.
+    keep_for_chat is the (compacted) prepared images the plan used; they stay reserved
+    for the chat below until clear_chat_images() is called or a new plan replaces them.
+    """
+    release_prepared_images()
+    governor = get_memory_governor()
+    session_id = get_session_id()
+    governor.release(session_id)
+    st.session_state.pop("chat_images", None)
+    if keep_for_chat:
+        reserved, _ = governor.reserve(
+            session_id, CHAT_IMAGES_KEY, sum(prepared["size"] for prepared in keep_for_chat), wait=False
+        )
+        if reserved:
+            st.session_state.chat_images = keep_for_chat
+        else:
+            st.info("Your screenshots were used for the plan but couldn't be kept for chat. Upload them again to discuss them.")
+    # A new widget key gives an empty uploader; Streamlit drops the old files with the old widget
+    st.session_state.uploader_generation = st.session_state.get("uploader_generation", 0) + 1
+
+
+def clear_chat_images():
+    """Drops the screenshots kept from the last plan and their memory reservation"""
+    st.session_state.pop("chat_images", None)
+    get_memory_governor().release(get_session_id(), [CHAT_IMAGES_KEY])
+
+# Fallback token budget if config/prompts.yaml has no `budget` section
+DEFAULT_BUDGET_CONFIG = {
+    "max_input_tokens": 24000,
+    "chars_per_token": 4.0,
+    "tool_overhead_tokens": 300,
+    "near_duplicate_bits": 4,
+    "compacted_image_dimension": 1536,
+    "min_user_input_chars": 1500,
+}
+IMAGE_TILE_SIZE = 768  # px, Gemini bills larger images per 768x768 tile
+IMAGE_TILE_TOKENS = 258
+
+
+def estimate_text_tokens(text: str, chars_per_token: float) -> int:
+    """Rough token count for text (Gemini averages ~4 characters per token for English)"""
+    return int(len(text) / chars_per_token) + 1
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini image cost: 258 tokens up to 384px, otherwise 258 per 768x768 tile"""
+    if width <= 384 and height <= 384:
+        return IMAGE_TILE_TOKENS
+    return -(-width // IMAGE_TILE_SIZE) * -(-height // IMAGE_TILE_SIZE) * IMAGE_TILE_TOKENS
+
+
+def dedupe_pasted_text(text: str) -> str:
+    """
+    Removes repeated lines (common when chats are pasted more than once) and
+    collapses runs of blank lines. Short lines like "ok" are kept, since repeats there carry meaning.
+    """
+    seen = set()
+    lines = []
+    for line in text.splitlines():
+        key = " ".join(line.lower().split())
+        if len(key) >= 12:
+            if key in seen:
+                continue
+            seen.add(key)
+        if not key and lines and not lines[-1].strip():
+            continue
+        lines.append(line)
+    return "\n".join(lines).strip()
+
+
+def _truncate_middle(text: str, max_chars: int) -> str:
+    """Keeps the start and end of the story, where context and the latest events usually are"""
+    if len(text) <= max_chars:
+        return text
+    head = int(max_chars * 0.6)
+    tail = max_chars - head
+    return f"{text[:head].rstrip()}\n[...]\n{text[-tail:].lstrip()}"
+
+
+def _downscale_prepared_image(prepared: Dict[str, Any], max_dimension: int) -> Dict[str, Any]:
+    """Re-encodes a prepared image at a smaller size so it costs fewer tiles"""
+    with PILImage.open(io.BytesIO(prepared["image"].content)) as img:
+        data = _downscale_image(img, prepared["format"], max_dimension)
+        width, height = img.width, img.height
+    return {
+        **prepared,
+        "size": len(data),
+        "width": width,
+        "height": height,
+        "image": AgnoImage(content=data, format=prepared["format"], mime_type=f"image/{prepared['format']}"),
+    }
+
+
+def estimate_request_tokens(
+    config: Dict[str, Any],
+    user_input: str,
+    prepared_images: List[Dict[str, Any]],
+    music_recommendations: str,
+    budget_config: Dict[str, Any],
+) -> Dict[str, int]:
+    """Estimated input tokens per agent: instructions, runtime prompt, screenshots and extras"""
+    chars_per_token = budget_config["chars_per_token"]
+    image_tokens = sum(estimate_image_tokens(p["width"], p["height"]) for p in prepared_images)
+
+    estimates = {}
+    for agent_key in AGENT_ORDER:
+        agent_config = config['agents'][agent_key]
+        instructions = agent_config['instructions']
+        if not isinstance(instructions, str):
+            instructions = "\n".join(instructions)
+        prompt = agent_config['runtime_prompt'].format(user_input=user_input)
+
+        tokens = estimate_text_tokens(instructions + prompt, chars_per_token) + image_tokens
+        if agent_key == 'routine_planner':
+            tokens += estimate_text_tokens(music_recommendations, chars_per_token)
+        if agent_key == 'brutal_honesty':
+            tokens += budget_config["tool_overhead_tokens"]
+        estimates[agent_key] = tokens
+    return estimates
+
+
+def plan_request_budget(config: Dict[str, Any], user_input: str, prepared_images: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Pre-dispatch token budgeting for one submission across all four agents.
+    If the estimate exceeds budget.max_input_tokens, compacts deterministically, cheapest loss first:
+    1. drop repeated pasted lines  2. drop near-duplicate screenshots  3. trim the song list
+    4. downscale screenshots  5. drop trailing screenshots  6. shorten the middle of the story
+    Returns the (possibly compacted) input, images, music block, per-agent estimates and the steps taken.
+    """
+    budget_config = {**DEFAULT_BUDGET_CONFIG, **config.get('budget', {})}
+    limit = budget_config["max_input_tokens"]
+    music_eras = len(ERA_IDS)
+    music_recommendations = get_music_recommendations_text(music_eras)
+    images = list(prepared_images)
+    steps = []
+
+    def estimate() -> Dict[str, int]:
+        return estimate_request_tokens(config, user_input, images, music_recommendations, budget_config)
+
+    initial = estimate()
+    estimates = initial
+
+    def over() -> bool:
+        return sum(estimates.values()) > limit
+
+    if over():
+        deduped = dedupe_pasted_text(user_input)
+        # The dedupe strips the ends, so compare against the stripped story: trailing spaces aren't repeated text
+        stripped = user_input.strip()
+        if len(deduped) < len(stripped):
+            steps.append(f"removed {len(stripped) - len(deduped)} chars of repeated text")
+            user_input = deduped
+            estimates = estimate()
+
+    if over():
+        kept = []
+        for prepared in images:
+            if any(bin(prepared["dhash"] ^ other["dhash"]).count("1") <= budget_config["near_duplicate_bits"] for other in kept):
+                steps.append(f"dropped near-duplicate screenshot {prepared['name']}")
+                continue
+            kept.append(prepared)
+        images = kept
+        estimates = estimate()
+
+    if over() and music_eras > 1:
+        music_eras = 2
+        music_recommendations = get_music_recommendations_text(music_eras)
+        steps.append("trimmed song list to the two most recent eras")
+        estimates = estimate()
+
+    if over():
+        max_dimension = budget_config["compacted_image_dimension"]
+        if any(max(p["width"], p["height"]) > max_dimension for p in images):
+            images = [
+                _downscale_prepared_image(p, max_dimension) if max(p["width"], p["height"]) > max_dimension else p
+                for p in images
+            ]
+            steps.append(f"downscaled screenshots to {max_dimension}px")
+            estimates = estimate()
+
+    while over() and len(images) > 1:
+        steps.append(f"dropped screenshot {images.pop()['name']}")
+        estimates = estimate()
+
+    if over():
+        # Every agent's prompt carries the story, so each character saved counts once per agent
+        excess_chars = (sum(estimates.values()) - limit) * budget_config["chars_per_token"] / len(AGENT_ORDER)
+        max_chars = max(budget_config["min_user_input_chars"], int(len(user_input) - excess_chars))
+        if max_chars < len(user_input):
+            steps.append(f"shortened story from {len(user_input)} to {max_chars} chars")
+            user_input = _truncate_middle(user_input, max_chars)
+            estimates = estimate()
+
+    total = sum(estimates.values())
+    if steps:
+        logger.info(f"Token budget: {sum(initial.values())} -> {total} estimated tokens (limit {limit}): {'; '.join(steps)}")
+    else:
+        logger.info(f"Token budget: {total} estimated tokens (limit {limit})")
+    if total > limit:
+        logger.warning(f"Token budget still exceeded after compaction: {total} > {limit}")
+
+    return {
+        "user_input": user_input,
+        "images": images,
+        "music_recommendations": music_recommendations,
+        "estimates": estimates,
+        "estimated_total": total,
+        "compactions": steps,
+    }
+
+
+# Fallback admission limits if config/prompts.yaml has no `admission` section
+DEFAULT_ADMISSION_CONFIG = {
+    "backend": "memory",
+    "max_concurrent": 4,
+    "max_in_flight_per_client": 2,
+    "queue_timeout": 120,
+    "trusted_proxies": 1,
+    "session_limit": {"max_requests": 5, "window_seconds": 600},
+    "client_limit": {"max_requests": 15, "window_seconds": 3600},
+    # Chat messages are cheaper and come in runs, so they have their own windows
+    "chat_session_limit": {"max_requests": 30, "window_seconds": 600},
+    "chat_client_limit": {"max_requests": 120, "window_seconds": 3600},
+}
+
+ADMISSION_MESSAGES = {
+    "session_rate": "💛 You've asked for a few plans in a short time. Take a breath, then try again in a few minutes.",
+    "client_rate": "⏳ Too many requests from your network right now. Please try again a little later.",
+    "in_flight": "⏳ Your previous request is still running. Please wait for it to finish.",
+    "queue_timeout": "🔧 We're at capacity right now. Please try again in a few minutes.",
+    "chat_session_rate": "💛 You've sent a lot of messages in a short time. Take a breath, then keep chatting in a few minutes.",
+    "chat_client_rate": "⏳ Too many messages from your network right now. Please try again a little later.",
+}
+
+
+class InMemoryWindowStore:
+    """Sliding-window request counters kept in this process (one deque of timestamps per key)"""
+
+    def __init__(self):
+        self._hits: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, max_requests: int, window_seconds: float) -> bool:
+        """Records a request for key and returns False if it would exceed the window limit"""
+        now = time.time()
+        with self._lock:
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - window_seconds:
+                hits.popleft()
+            if len(hits) >= max_requests:
+                return False
+            hits.append(now)
+
+            # Drop idle keys so abandoned sessions don't accumulate
+            if len(self._hits) > 10000:
+                self._hits = {k: v for k, v in self._hits.items() if v and v[-1] > now - window_seconds}
+            return True
+
+
+class FirestoreWindowStore:
+    """
+    Sliding-window request counters shared across workers via the Firestore `rate_limits` collection.
+    Keys are hashed so no client addresses are stored. Falls back to in-memory counters on errors.
+    """
+
+    def __init__(self, db: firestore.Client):
+        self._db = db
+        self._fallback = InMemoryWindowStore()
+
+    def hit(self, key: str, max_requests: int, window_seconds: float) -> bool:
+        """Records a request for key and returns False if it would exceed the window limit"""
+        doc_ref = self._db.collection("rate_limits").document(hashlib.sha256(key.encode()).hexdigest())
+
+        @firestore.transactional
+        def record(transaction) -> bool:
+            now = time.time()
+            snapshot = doc_ref.get(transaction=transaction)
+            hits = snapshot.to_dict().get("hits", []) if snapshot.exists else []
+            hits = [t for t in hits if t > now - window_seconds]
+            if len(hits) >= max_requests:
+                return False
+            hits.append(now)
+            transaction.set(doc_ref, {"hits": hits, "expires_at": now + window_seconds})
+            return True
+
+        try:
+            return get_circuit_breaker("firestore").call(lambda: record(self._db.transaction()))
+        except Exception as e:
+            logger.error(f"Error updating shared rate limit, using local counters: {str(e)}")
+            return self._fallback.hit(key, max_requests, window_seconds)
+
+
+class AdmissionController:
+    """
+    Admission control in front of the agent pipeline:
+    - sliding-window limits per session and per client address
+    - a cap on requests in flight per client
+    - a round-robin fair queue across clients once global capacity is saturated
+    """
+
+    def __init__(self, admission_config: Dict[str, Any], store):
+        self.config = admission_config
+        self.store = store
+        self._condition = threading.Condition()
+        self._in_flight: Dict[str, int] = {}
+        # Requests that passed the in-flight check and are still on their rate-limit checks
+        self._pending: Dict[str, int] = {}
+        self._total_in_flight = 0
+        # client -> deque of waiting tickets; order of clients is the round-robin order
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.metrics = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_session_rate": 0,
+            "rejected_client_rate": 0,
+            "rejected_in_flight": 0,
+            "rejected_queue_timeout": 0,
         }
-        </style>
+
+    def _count(self, metric: str):
+        self.metrics[metric] += 1
+        if metric.startswith("rejected"):
+            logger.warning(f"Request rejected ({metric}), admission metrics: {self.get_metrics()}")
+
+    def _waiting(self, client: str) -> int:
+        return len(self._queues.get(client, ())) + self._pending.get(client, 0)
+
+    def _unpend(self, client: str):
+        self._pending[client] -= 1
+        if not self._pending[client]:
+            del self._pending[client]
+
+    def _start(self, client: str):
+        self._in_flight[client] = self._in_flight.get(client, 0) + 1
+        self._total_in_flight += 1
+        self.metrics["admitted"] += 1
+
+    def _dispatch(self):
+        """Grants free slots to waiting clients in round-robin order (lock must be held)"""
+        max_in_flight = self.config["max_in_flight_per_client"]
+        while self._total_in_flight < self.config["max_concurrent"]:
+            client = next((c for c in self._queues if self._in_flight.get(c, 0) < max_in_flight), None)
+            if client is None:
+                break
+            tickets = self._queues.pop(client)
+            tickets.popleft()["granted"] = True
+            if tickets:
+                # Re-append so this client goes to the back of the rotation
+                self._queues[client] = tickets
+            self._start(client)
+        self._condition.notify_all()
+
+    def acquire(self, session_id: str, client: str, on_queued=None, scope: str = "plan") -> tuple[bool, Optional[str]]:
+        """
+        Blocks until the request may run or is rejected.
+        Returns (admitted, reason) where reason is a key of ADMISSION_MESSAGES.
+        on_queued is called once if the request has to wait for capacity.
+        scope "chat" uses the chat_* rate-limit windows instead of the plan ones.
+        """
+        prefix = "chat_" if scope == "chat" else ""
+        with self._condition:
+            if self._in_flight.get(client, 0) + self._waiting(client) >= self.config["max_in_flight_per_client"]:
+                self._count("rejected_in_flight")
+                return False, "in_flight"
+            # Hold the slot while the rate limits are checked, so concurrent requests can't all pass
+            self._pending[client] = self._pending.get(client, 0) + 1
+
+        try:
+            session_limit = self.config[f"{prefix}session_limit"]
+            session_ok = self.store.hit(f"{prefix}session:{session_id}", session_limit["max_requests"], session_limit["window_seconds"])
+            client_limit = self.config[f"{prefix}client_limit"]
+            client_ok = session_ok and self.store.hit(f"{prefix}client:{client}", client_limit["max_requests"], client_limit["window_seconds"])
+        except Exception:
+            with self._condition:
+                self._unpend(client)
+            raise
+
+        with self._condition:
+            self._unpend(client)
+            if not session_ok:
+                self._count("rejected_session_rate")
+                return False, f"{prefix}session_rate"
+            if not client_ok:
+                self._count("rejected_client_rate")
+                return False, f"{prefix}client_rate"
+
+            if self._total_in_flight < self.config["max_concurrent"] and not self._queues:
+                self._start(client)
+                return True, None
+
+            ticket = {"granted": False}
+            self._queues.setdefault(client, deque()).append(ticket)
+            self.metrics["queued"] += 1
+            if on_queued:
+                on_queued()
+
+            deadline = time.monotonic() + self.config["queue_timeout"]
+            while not ticket["granted"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    tickets = self._queues.get(client)
+                    if tickets is not None:
+                        tickets.remove(ticket)
+                        if not tickets:
+                            del self._queues[client]
+                    self._count("rejected_queue_timeout")
+                    return False, "queue_timeout"
+                self._condition.wait(remaining)
+            return True, None
+
+    def release(self, client: str):
+        """Frees the slot held by a finished request and hands it to the next waiting client"""
+        with self._condition:
+            self._in_flight[client] = self._in_flight.get(client, 1) - 1
+            if self._in_flight[client] <= 0:
+                del self._in_flight[client]
+            self._total_in_flight -= 1
+            self._dispatch()
+
+    def get_metrics(self) -> Dict[str, int]:
+        """Counters plus current in-flight and queue depth"""
+        with self._condition:
+            return {
+                **self.metrics,
+                "in_flight": self._total_in_flight,
+                "queue_depth": sum(len(tickets) for tickets in self._queues.values()),
+            }
+
+
+@st.cache_resource
+def get_admission_controller(admission_config: Optional[Dict[str, Any]] = None) -> AdmissionController:
+    """
+    Creates the process-wide admission controller.
+    Uses Streamlit caching so all sessions share the same counters and queue.
     """
-    st.markdown(hide_streamlit_style, unsafe_allow_html=True)
+    admission_config = {**DEFAULT_ADMISSION_CONFIG, **(admission_config or {})}
+
+    store = InMemoryWindowStore()
+    if admission_config["backend"] == "firestore":
+        db = get_firestore_client()
+        if db is not None:
+            store = FirestoreWindowStore(db)
+        else:
+            logger.warning("Firestore not configured, admission control using in-memory counters")
+
+    logger.info(f"Admission controller created with {type(store).__name__}")
+    return AdmissionController(admission_config, store)
+
+
+def get_session_id() -> str:
+    """Random id for this browser session, used for per-session limits"""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def get_client_address(trusted_proxies: int = DEFAULT_ADMISSION_CONFIG["trusted_proxies"]) -> str:
+    """
+    Best-effort client address. Behind trusted_proxies reverse proxies this is the
+    X-Forwarded-For hop appended by the outermost trusted proxy; earlier hops are
+    client-supplied and can be forged, so they are never used.
+    Falls back to the session id so unidentified clients don't share one bucket.
+    """
+    try:
+        hops = [hop.strip() for hop in st.context.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+        if trusted_proxies > 0 and len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+        address = getattr(st.context, "ip_address", None)
+        if address:
+            return address
+    except Exception:
+        pass
+    return f"session:{get_session_id()}"
+
+
+# Fallback chat settings if config/prompts.yaml has no `chat` section
+DEFAULT_CHAT_CONFIG = {
+    "memory_backend": "session",
+    "max_recent_turns": 6,
+    "max_summary_chars": 1200,
+    "max_transcript_messages": 50,
+    "memory_ttl_hours": 24,
+    "summary_instructions": [
+        "You maintain a short running summary of a supportive conversation about a breakup.",
+        "Keep names, key events, feelings and anything the user asked to remember. Drop small talk.",
+        "Write in third person about 'the user', plain prose, no headings.",
+    ],
+    "turn_prompt": "{memory}**User's new message:**\n{message}\n\nReply conversationally as yourself in 80-200 words.",
+}
+
+
+def new_conversation_memory() -> Dict[str, Any]:
+    """Empty conversation memory: rolling summary plus the most recent turns"""
+    return {"summary": "", "turns": [], "images_sent": False}
+
+
+class SessionMemoryStore:
+    """Keeps conversation memory in this browser session only (lost when the tab closes)"""
+
+    def load(self, conversation_id: str) -> Dict[str, Any]:
+        return st.session_state.setdefault("chat_memory", {}).get(conversation_id) or new_conversation_memory()
+
+    def save(self, conversation_id: str, memory: Dict[str, Any]):
+        st.session_state.setdefault("chat_memory", {})[conversation_id] = memory
+
+    def clear(self, conversation_id: str):
+        st.session_state.setdefault("chat_memory", {}).pop(conversation_id, None)
+
+
+class FirestoreMemoryStore:
+    """
+    Persists conversation memory in the Firestore `conversations` collection.
+    Only the rolling summary and recent turns are stored, never screenshots.
+    Each save sets `expires_at` ttl_hours ahead for a Firestore TTL policy, since
+    documents are keyed by a per-tab session id and become unreachable once the tab closes.
+    """
+
+    def __init__(self, db: firestore.Client, ttl_hours: float):
+        self._db = db
+        self._ttl = timedelta(hours=ttl_hours)
+
+    def _doc(self, conversation_id: str):
+        return self._db.collection("conversations").document(hashlib.sha256(conversation_id.encode()).hexdigest())
+
+    def load(self, conversation_id: str) -> Dict[str, Any]:
+        try:
+            snapshot = get_circuit_breaker("firestore").call(self._doc(conversation_id).get)
+        except Exception as e:
+            logger.error(f"Error loading conversation memory, starting fresh: {str(e)}")
+            return new_conversation_memory()
+        if not snapshot.exists:
+            return new_conversation_memory()
+        data = snapshot.to_dict()
+        # TTL deletion can lag by a day or more, so don't resurrect expired memory
+        expires_at = data.pop("expires_at", None)
+        if expires_at is not None and expires_at < datetime.now(timezone.utc):
+            return new_conversation_memory()
+        return {**new_conversation_memory(), **data}
+
+    def save(self, conversation_id: str, memory: Dict[str, Any]):
+        try:
+            get_circuit_breaker("firestore").call(
+                self._doc(conversation_id).set,
+                {**memory, "updated_at": firestore.SERVER_TIMESTAMP, "expires_at": datetime.now(timezone.utc) + self._ttl}
+            )
+        except Exception as e:
+            logger.error(f"Error saving conversation memory: {str(e)}")
+
+    def clear(self, conversation_id: str):
+        try:
+            get_circuit_breaker("firestore").call(self._doc(conversation_id).delete)
+        except Exception as e:
+            logger.error(f"Error clearing conversation memory: {str(e)}")
+
+
+def get_memory_store(chat_config: Dict[str, Any]):
+    """Returns the configured conversation memory store, defaulting to in-session memory"""
+    if chat_config["memory_backend"] == "firestore":
+        db = get_firestore_client()
+        if db is not None:
+            return FirestoreMemoryStore(db, chat_config["memory_ttl_hours"])
+        logger.warning("Firestore not configured, chat memory kept in session")
+    return SessionMemoryStore()
+
+
+def compact_memory(memory: Dict[str, Any], chat_config: Dict[str, Any], summarizer: Optional[Agent]):
+    """
+    Folds the oldest turns into the rolling summary once there are more than max_recent_turns.
+    Compacts down to half the window so the summarizer runs every few turns, not every turn.
+    """
+    max_recent_turns = chat_config["max_recent_turns"]
+    if len(memory["turns"]) <= max_recent_turns:
+        return
+
+    keep = max(1, max_recent_turns // 2)
+    folded, memory["turns"] = memory["turns"][:-keep], memory["turns"][-keep:]
+    folded_text = "\n".join(f"User: {turn['user']}\n{turn['agent_name']}: {turn['agent']}" for turn in folded)
+
+    summary = ""
+    if summarizer is not None:
+        try:
+            response = call_gemini(
+                summarizer,
+                f"Current summary:\n{memory['summary'] or '(none)'}\n\n"
+                f"Fold these older messages into the summary, in under {chat_config['max_summary_chars']} characters:\n"
+                f"{folded_text}"
+            )
+            summary = response.content or ""
+        except Exception as e:
+            logger.error(f"Error summarizing conversation, keeping extractive summary: {str(e)}")
+
+    if not summary:
+        # Extractive fallback: keep what the user said, newest last
+        summary = " ".join([memory["summary"]] + [f"The user said: {turn['user']}" for turn in folded]).strip()
+
+    # Keep the newest part if the summary outgrows its budget
+    memory["summary"] = summary[-chat_config["max_summary_chars"]:]
+    logger.info(f"Compacted {len(folded)} turns into rolling summary ({len(memory['summary'])} chars)")
+
+
+def build_chat_prompt(memory: Optional[Dict[str, Any]], message: str, chat_config: Dict[str, Any]) -> str:
+    """Builds a turn prompt from the rolling summary, the recent turns and the new message"""
+    memory_text = ""
+    if memory and memory["summary"]:
+        memory_text += f"**Earlier in this conversation (summary):**\n{memory['summary']}\n\n"
+    if memory and memory["turns"]:
+        recent = "\n".join(f"User: {turn['user']}\nYou: {turn['agent']}" for turn in memory["turns"])
+        memory_text += f"**Recent messages:**\n{recent}\n\n"
+    return chat_config["turn_prompt"].format(memory=memory_text, message=message)
+
+
+def run_chat_turn(
+    agent: Agent,
+    message: str,
+    memory: Optional[Dict[str, Any]],
+    images: List[AgnoImage],
+    chat_config: Dict[str, Any],
+    summarizer: Optional[Agent] = None,
+) -> str:
+    """
+    Runs one chat turn. With memory, screenshots are only attached on the first turn
+    and the prompt stays bounded by the summary budget plus max_recent_turns.
+    Without memory (None), every turn is independent and carries the screenshots.
+    """
+    if memory is not None and memory["images_sent"]:
+        images = []
+
+    prompt = build_chat_prompt(memory, message, chat_config)
+    start = time.perf_counter()
+    response = call_gemini(agent, prompt, images)
+    elapsed = time.perf_counter() - start
+
+    metrics = getattr(response, "metrics", None)
+    input_tokens = getattr(metrics, "input_tokens", None)
+    logger.info(
+        f"Chat turn with {agent.name}: prompt={len(prompt)} chars, images={len(images)}, "
+        f"input_tokens={input_tokens}, latency={elapsed:.2f}s"
+    )
+
+    reply = response.content or ""
+    if memory is not None:
+        memory["images_sent"] = memory["images_sent"] or bool(images)
+        memory["turns"].append({"user": message, "agent": reply, "agent_name": agent.name})
+        compact_memory(memory, chat_config, summarizer)
+    return reply
+
+
+def _forget_conversation(store, agent_keys: List[str]):
+    """Drops the stored memory with every agent when the user switches remembering off"""
+    if not st.session_state.get("chat_remember"):
+        for agent_key in agent_keys:
+            store.clear(f"{get_session_id()}:{agent_key}")
+
+
+@st.fragment
+def chat_section(config: Dict[str, Any], final_api_key: Optional[str]):
+    """
+    Back-and-forth chat with one squad member as a fragment,
+    so chatting doesn't rerun (and clear) the recovery plan above it.
+    """
+    chat_config = {**DEFAULT_CHAT_CONFIG, **config.get('chat', {})}
+    agents_config = config['agents']
+
+    st.markdown("---")
+    st.subheader("💬 Keep Talking")
+
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        agent_key = st.selectbox(
+            "Who would you like to talk to?",
+            options=list(agents_config),
+            format_func=lambda key: agents_config[key]['name'],
+            key="chat_agent"
+        )
+
+    conversation_id = f"{get_session_id()}:{agent_key}"
+    store = get_memory_store(chat_config)
+
+    with col2:
+        remember = st.toggle(
+            "Remember this conversation",
+            value=False,
+            key="chat_remember",
+            help="Off: every message is answered on its own. On: a short summary of the chat is kept "
+                 + ("on our server" if chat_config["memory_backend"] == "firestore" else "in this session")
+                 + " until you switch this off.",
+            on_change=_forget_conversation,
+            args=(store, list(agents_config))
+        )
+
+    # Chat reruns only this fragment, so keep this session's reservations from idling out
+    get_memory_governor().touch(get_session_id())
+    kept_images = st.session_state.get("chat_images")
+    if kept_images:
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            st.caption(f"📎 {len(kept_images)} screenshot(s) from your recovery plan are shared with this chat")
+        with col2:
+            st.button("Forget screenshots", key="chat_forget_images", on_click=clear_chat_images)
+
+    transcripts = st.session_state.setdefault("chat_transcripts", {})
+    transcript = transcripts.setdefault(agent_key, [])
+
+    for entry in transcript:
+        with st.chat_message(entry["role"]):
+            st.markdown(entry["content"])
+
+    message = st.chat_input(f"Message {agents_config[agent_key]['name']}...", key="chat_input")
+    if not message:
+        return
+
+    if not final_api_key:
+        st.warning("Please configure your API key in the sidebar first!")
+        return
+    if not validate_input(message):
+        st.error(f"Your message is too long. Please keep it under {MAX_INPUT_LENGTH} characters.")
+        return
+
+    message = sanitize_input(message, config.get('safety'))
+    with st.chat_message("user"):
+        st.markdown(message)
+
+    triage = classify_crisis(message, config.get('crisis'))
+    if triage["is_crisis"]:
+        logger.warning(f"Crisis triage triggered in chat (score={triage['score']:.1f})")
+        render_crisis_response(config, final_api_key, message, scope="chat")
+        return
+    if triage["show_resources"]:
+        render_crisis_resources(config['crisis'])
+
+    controller = get_admission_controller(config.get('admission'))
+    client_address = get_client_address(controller.config["trusted_proxies"])
+    admitted, reason = controller.acquire(
+        get_session_id(),
+        client_address,
+        on_queued=lambda: st.info("⏳ Lots of people are looking for support right now. Your message is in line, hang tight..."),
+        scope="chat"
+    )
+    if not admitted:
+        st.warning(ADMISSION_MESSAGES[reason])
+        return
+
+    try:
+        model = Gemini(id=get_model_config(config)['id'], api_key=final_api_key)
+        agent = build_agent(agent_key, model, agents_config)
+        summarizer = Agent(model=model, name="Summarizer", instructions=chat_config["summary_instructions"])
+
+        memory = store.load(conversation_id) if remember else None
+        # New uploads take precedence over the screenshots kept from the last plan
+        uploaded_files = get_reserved_uploads()
+        kept_images = st.session_state.get("chat_images") or []
+        needs_images = (uploaded_files or kept_images) and (memory is None or not memory["images_sent"])
+        if not needs_images:
+            images = []
+        elif uploaded_files:
+            images = process_images(uploaded_files)
+        else:
+            images = [prepared["image"] for prepared in kept_images]
+
+        with st.chat_message("assistant"):
+            with st.spinner(config['ui']['loading_messages'][agent_key]):
+                reply = run_chat_turn(agent, message, memory, images, chat_config, summarizer)
+            st.markdown(reply)
+
+        if memory is not None:
+            store.save(conversation_id, memory)
+
+        transcript.extend([{"role": "user", "content": message}, {"role": "assistant", "content": reply}])
+        del transcript[:-chat_config["max_transcript_messages"]]
+
+    except Exception as e:
+        logger.error(f"Error during chat: {str(e)}")
+        st.error(get_api_error_message(e, "An error occurred while replying. Please try again."))
+    finally:
+        controller.release(client_address)
+
+
+def main():
+    """Main application entry point"""
+
+    # Load configuration
+    config = load_config()
+    ui_config = config['ui']
+    agents_config = config['agents']
+
+    # Set page config
+    st.set_page_config(
+        page_title=ui_config['app_title'],
+        page_icon=ui_config['page_icon'],
+        layout="wide"
+    )
+
+    # Health/status surface: ?status=<STATUS_PAGE_TOKEN> shows dependency health instead of the app.
+    # Disabled unless the token is set, since it exposes raw errors and allocation sites.
+    status_token = env_config("STATUS_PAGE_TOKEN", default="")
+    if status_token and hmac.compare_digest(st.query_params.get("status", ""), status_token):
+        st.json(get_health_status())
+        return
+
+    # Drain waitlist signups queued during a Firestore outage once it is healthy again
+    schedule_waitlist_flush()
+
+    # Hide Streamlit branding (static CSS defined once per process)
+    st.markdown(HIDE_STREAMLIT_STYLE, unsafe_allow_html=True)
 
     # Configure analytics tracking (lazy initialization)
     analytics_kwargs = {}
 
-    # Only initialize Firestore analytics if secrets are configured
-    if has_firebase_secrets():
+    # Only initialize Firestore analytics if secrets are configured and Firestore is healthy
+    if has_firebase_secrets() and get_circuit_breaker("firestore").is_available():
         firestore_key_path = get_firestore_key_path()
         if firestore_key_path:
             try:
@@ -632,7 +2483,7 @@ def main():
                 logger.warning(f"Could not configure Firestore analytics: {str(e)}")
 
     # Wrap app with analytics tracking
-    with streamlit_analytics.track(**analytics_kwargs):
+    with timed_region("full page"), streamlit_analytics.track(**analytics_kwargs):
         _main_content(config, ui_config, agents_config)
 
 
@@ -677,6 +2528,199 @@ Currently, our agents listen and guide. Soon, you can chat with them back-and-fo
         st.success("You're on the list!")
 
 
+def _run_recovery_pipeline(config, ui_config, agents_config, final_api_key, sanitized_input, uploaded_files):
+    """
+    Runs the four agents on one already sanitized and triaged submission and renders their responses.
+    Returns the prepared screenshots that were sent, so the chat can keep using them.
+    """
+    # Fail fast instead of queueing up behind timeouts while Gemini is unhealthy
+    if not get_circuit_breaker("gemini").is_available():
+        st.error("🔧 Service temporarily unavailable. Please try again in a few minutes.")
+        return []
+
+    # Estimate tokens and compact the request before anything is dispatched
+    prepared_images = collect_prepared_images(uploaded_files) if uploaded_files else []
+    budget = plan_request_budget(config, sanitized_input, prepared_images)
+    sanitized_input = budget["user_input"]
+    all_images = [prepared["image"] for prepared in budget["images"]]
+    if budget["compactions"]:
+        # Dropped screenshots and a shortened story change what the agents see, so say so
+        st.info(
+            "📏 Your story and screenshots were too long to send in full, so before sending we "
+            + "; ".join(budget["compactions"]) + "."
+        )
+
+    # Initialize agents
+    therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent = initialize_agents(
+        final_api_key, config, budget["music_recommendations"]
+    )
+
+    if all([therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent]):
+        try:
+            st.header("Your Personalized Recovery Plan")
+
+            agents = {
+                'therapist': therapist_agent,
+                'closure': closure_agent,
+                'routine_planner': routine_planner_agent,
+                'brutal_honesty': brutal_honesty_agent,
+            }
+            for agent_key in AGENT_ORDER:
+                with st.spinner(ui_config['loading_messages'][agent_key]):
+                    prompt = agents_config[agent_key]['runtime_prompt'].format(user_input=sanitized_input)
+                    result = run_agent(agents[agent_key], prompt, all_images, budget["estimates"][agent_key])
+
+                    # Each agent's response with its own colored border
+                    st.markdown(f"""<div style="border-left: 4px solid {AGENT_COLORS[agent_key]}; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
+                    st.subheader(ui_config['section_titles'][agent_key])
+                    st.markdown(result["content"])
+                    st.markdown("</div>", unsafe_allow_html=True)
+
+        except Exception as e:
+            logger.error(f"Error during analysis: {str(e)}")
+            st.error(get_api_error_message(e, "An error occurred during analysis. Please try again."))
+    else:
+        st.error("Our service is temporarily unavailable. Please try again in a few minutes.")
+    return budget["images"]
+
+
+@st.cache_data(max_entries=50, show_spinner=False)
+def get_thumbnail(file_key: str, _file) -> bytes:
+    """
+    Small JPEG preview of an uploaded screenshot, cached per upload.
+    Takes the upload itself (not its bytes) and reads it only on a cache miss, so reruns
+    don't copy every full-size upload; the underscore keeps Streamlit from hashing it.
+    """
+    _file.seek(0)
+    with PILImage.open(_file) as img:
+        img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+@st.cache_data
+def get_footer_html(email: str) -> str:
+    """Footer HTML, built once per process"""
+    if email:
+        contact = f'<a href="mailto:{email}">drop me a mail</a>'
+    else:
+        contact = "drop me a mail"
+    return f"""
+<div style="text-align: center;">
+<h3>👨‍💻 A Humble Request</h3>
+<p>It takes 10s to break a system, but days to build one. Please spare my API credits!</p>
+<p>Rather than stress-testing, {contact} and I'll share the full list of limitations myself. Let's collaborate instead!</p>
+</div>
+        """
+
+
+@contextmanager
+def timed_region(name: str):
+    """Logs how long a page region took to render (set LOG_RENDER_TIMINGS=true to see it)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.log(RENDER_TIMING_LOG_LEVEL, f"Rendered {name} in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+@st.fragment
+def input_section(config: Dict[str, Any], final_api_key: Optional[str]):
+    """
+    Story, screenshots and the recovery plan as a fragment.
+    Typing, uploading and submitting rerun only this section, not the CSS,
+    sidebar, welcome text, chat or footer.
+    """
+    with timed_region("input section"):
+        ui_config = config['ui']
+        agents_config = config['agents']
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.subheader("Share Your Feelings")
+            user_input = st.text_area(
+                "How are you feeling? What happened?",
+                height=150,
+                placeholder="Tell us your story...",
+                max_chars=MAX_INPUT_LENGTH,
+                help=f"Maximum {MAX_INPUT_LENGTH} characters"
+            )
+
+        with col2:
+            st.subheader("Upload Chat Screenshots (Optional)")
+            uploaded_files = st.file_uploader(
+                f"Upload up to {MAX_FILES} screenshots (max 10MB each)",
+                type=["jpg", "jpeg", "png"],
+                accept_multiple_files=True,
+                key=get_uploader_key(),
+                help="Screenshots are processed in memory and never saved. The copies used for your plan stay "
+                     "available to the chat until you click \"Forget screenshots\" or start a new plan"
+            )
+
+            if uploaded_files and len(uploaded_files) > MAX_FILES:
+                st.warning(f"Maximum {MAX_FILES} files allowed. Only the first {MAX_FILES} will be processed.")
+                uploaded_files = uploaded_files[:MAX_FILES]
+
+            # Only uploads that fit the session and process memory ceilings go any further.
+            # Runs with no uploads too, so removing them all frees their reservations right away
+            uploaded_files = reserve_upload_memory(uploaded_files or [])
+
+            for file in uploaded_files:
+                try:
+                    st.image(get_thumbnail(_upload_key(file), file), caption=file.name, use_container_width=True)
+                except Exception:
+                    st.caption(f"Preview unavailable for {file.name}")
+
+            # Start preparing screenshots now so they're ready by the time the user submits
+            schedule_image_preparation(uploaded_files)
+
+        # Process button
+        if st.button("Get Recovery Plan 💝", type="primary"):
+            sanitized_input = sanitize_input(user_input, config.get('safety')) if user_input else ""
+            # Crisis triage runs locally before admission, so helplines are never queued or rate limited;
+            # only Maya's crisis response goes through admission
+            triage = classify_crisis(sanitized_input, config.get('crisis'))
+
+            if not user_input and not uploaded_files:
+                st.warning("Please share your feelings or upload screenshots to get help.")
+            elif user_input and not validate_input(user_input):
+                st.error(f"Your message is too long. Please keep it under {MAX_INPUT_LENGTH} characters.")
+            elif triage["is_crisis"]:
+                logger.warning(f"Crisis triage triggered (score={triage['score']:.1f}), skipping full pipeline")
+                render_crisis_response(config, final_api_key, sanitized_input)
+                release_upload_memory()
+            elif not final_api_key:
+                if triage["show_resources"]:
+                    render_crisis_resources(config['crisis'])
+                st.warning("Please configure your API key in the sidebar first!")
+            else:
+                if triage["show_resources"]:
+                    # Worrying but not explicit: keep the plan and show the helplines above it
+                    render_crisis_resources(config['crisis'])
+                controller = get_admission_controller(config.get('admission'))
+                client_address = get_client_address(controller.config["trusted_proxies"])
+                admitted, reason = controller.acquire(
+                    get_session_id(),
+                    client_address,
+                    on_queued=lambda: st.info("⏳ Lots of people are looking for support right now. You're in line, hang tight...")
+                )
+
+                if not admitted:
+                    st.warning(ADMISSION_MESSAGES[reason])
+                else:
+                    sent_images = []
+                    try:
+                        sent_images = _run_recovery_pipeline(config, ui_config, agents_config, final_api_key, sanitized_input, uploaded_files)
+                    finally:
+                        controller.release(client_address)
+                        # Free upload buffers as soon as the submission is done, whatever the outcome;
+                        # only the compacted copies the plan used are kept for the chat
+                        release_upload_memory(keep_for_chat=sent_images)
+                        logger.info("Submission complete, upload memory released")
+
+
 def _main_content(config, ui_config, agents_config):
     """Main content of the application (wrapped by analytics)"""
 
@@ -716,173 +2760,238 @@ def _main_content(config, ui_config, agents_config):
 
     # Main content
     st.title(ui_config['app_title'])
+    if not get_circuit_breaker("gemini").is_available():
+        st.warning("🔧 Our AI service is having trouble right now. Please check back in a few minutes.")
     st.markdown(ui_config['welcome_message'])
 
-    # Input section
-    col1, col2 = st.columns(2)
+    # Input and recovery plan (fragment so typing/uploading doesn't rerun the whole page)
+    input_section(config, final_api_key)
 
-    with col1:
-        st.subheader("Share Your Feelings")
-        user_input = st.text_area(
-            "How are you feeling? What happened?",
-            height=150,
-            placeholder="Tell us your story...",
-            max_chars=MAX_INPUT_LENGTH,
-            help=f"Maximum {MAX_INPUT_LENGTH} characters"
-        )
+    # Multi-turn chat (fragment so chatting keeps the recovery plan on screen)
+    chat_section(config, final_api_key)
 
-    with col2:
-        st.subheader("Upload Chat Screenshots (Optional)")
-        uploaded_files = st.file_uploader(
-            f"Upload up to {MAX_FILES} screenshots (max 10MB each)",
-            type=["jpg", "jpeg", "png"],
-            accept_multiple_files=True,
-            key="screenshots",
-            help="Screenshots are processed temporarily and deleted immediately after"
+    # Footer section
+    st.markdown("---")
+    st.markdown(get_footer_html(social_urls["email"]), unsafe_allow_html=True)
+
+
+class FakeAgent:
+    """
+    Offline stand-in for an Agno agent in batch mode: no network, deterministic reply,
+    token counts estimated at ~4 characters per token.
+    """
+
+    def __init__(self, name: str, instructions: Any, latency: float = 0.0):
+        self.name = name
+        self.instructions = instructions if isinstance(instructions, str) else "\n".join(instructions)
+        self.latency = latency
+
+    def run(self, prompt: str, images: Optional[List[AgnoImage]] = None) -> SimpleNamespace:
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+        content = f"[{self.name} offline reply {digest}] {prompt[:200]}"
+        return SimpleNamespace(
+            content=content,
+            metrics=SimpleNamespace(
+                input_tokens=(len(self.instructions) + len(prompt)) // 4,
+                output_tokens=len(content) // 4,
+            ),
         )
 
-        if uploaded_files:
-            if len(uploaded_files) > MAX_FILES:
-                st.warning(f"Maximum {MAX_FILES} files allowed. Only the first {MAX_FILES} will be processed.")
-                uploaded_files = uploaded_files[:MAX_FILES]
 
-            for file in uploaded_files:
-                st.image(file, caption=file.name, use_container_width=True)
-
-    # Process button
-    if st.button("Get Recovery Plan 💝", type="primary"):
-        if not final_api_key:
-            st.warning("Please configure your API key in the sidebar first!")
-        elif not user_input and not uploaded_files:
-            st.warning("Please share your feelings or upload screenshots to get help.")
-        elif user_input and not validate_input(user_input):
-            st.error(f"Your message is too long. Please keep it under {MAX_INPUT_LENGTH} characters.")
-        else:
-            # Sanitize input
-            sanitized_input = sanitize_input(user_input) if user_input else ""
+def build_batch_agents(
+    config: Dict[str, Any],
+    api_key: Optional[str],
+    fake_latency: Optional[float],
+    music_recommendations: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Fresh set of the four agents for one batch submission (fake ones when fake_latency is set)"""
+    agents_config = config['agents']
+    if fake_latency is not None:
+        agents = {
+            key: FakeAgent(agents_config[key]['name'], agents_config[key]['instructions'], fake_latency)
+            for key in AGENT_ORDER
+        }
+        if music_recommendations:
+            agents['routine_planner'].instructions += f"\n\n{music_recommendations}"
+        return agents
 
-            # Initialize agents
-            therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent = initialize_agents(
-                final_api_key, config
-            )
+    model = Gemini(id=get_model_config(config)['id'], api_key=api_key)
+    return {key: build_agent(key, model, agents_config, music_recommendations) for key in AGENT_ORDER}
 
-            if all([therapist_agent, closure_agent, routine_planner_agent, brutal_honesty_agent]):
-                try:
-                    st.header("Your Personalized Recovery Plan")
-
-                    # Process images if uploaded
-                    all_images = process_images(uploaded_files) if uploaded_files else []
-
-                    # Therapist Analysis
-                    with st.spinner(ui_config['loading_messages']['therapist']):
-                        therapist_prompt = agents_config['therapist']['runtime_prompt'].format(
-                            user_input=sanitized_input
-                        )
-
-                        response = therapist_agent.run(
-                            therapist_prompt,
-                            images=all_images
-                        )
-
-                        # Maya's response with blue border
-                        st.markdown("""<div style="border-left: 4px solid #4A90E2; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
-                        st.subheader(ui_config['section_titles']['therapist'])
-                        st.markdown(response.content)
-                        st.markdown("</div>", unsafe_allow_html=True)
-
-                    # Closure Messages
-                    with st.spinner(ui_config['loading_messages']['closure']):
-                        closure_prompt = agents_config['closure']['runtime_prompt'].format(
-                            user_input=sanitized_input
-                        )
-
-                        response = closure_agent.run(
-                            closure_prompt,
-                            images=all_images
-                        )
-
-                        # Harper's response with purple border
-                        st.markdown("""<div style="border-left: 4px solid #9B59B6; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
-                        st.subheader(ui_config['section_titles']['closure'])
-                        st.markdown(response.content)
-                        st.markdown("</div>", unsafe_allow_html=True)
-
-                    # Recovery Plan
-                    with st.spinner(ui_config['loading_messages']['routine_planner']):
-                        routine_prompt = agents_config['routine_planner']['runtime_prompt'].format(
-                            user_input=sanitized_input
-                        )
-
-                        response = routine_planner_agent.run(
-                            routine_prompt,
-                            images=all_images
-                        )
-
-                        # Jonas's response with green border
-                        st.markdown("""<div style="border-left: 4px solid #2ECC71; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
-                        st.subheader(ui_config['section_titles']['routine_planner'])
-                        st.markdown(response.content)
-                        st.markdown("</div>", unsafe_allow_html=True)
-
-                    # Honest Feedback
-                    with st.spinner(ui_config['loading_messages']['brutal_honesty']):
-                        honesty_prompt = agents_config['brutal_honesty']['runtime_prompt'].format(
-                            user_input=sanitized_input
-                        )
-
-                        response = brutal_honesty_agent.run(
-                            honesty_prompt,
-                            images=all_images
-                        )
-
-                        # Riya's response with red border
-                        st.markdown("""<div style="border-left: 4px solid #E74C3C; padding-left: 15px; margin: 25px 0;">""", unsafe_allow_html=True)
-                        st.subheader(ui_config['section_titles']['brutal_honesty'])
-                        st.markdown(response.content)
-                        st.markdown("</div>", unsafe_allow_html=True)
-
-                    # Clean up temp files after processing
-                    cleanup_temp_files()
-                    logger.info("Processing complete, temp files cleaned up")
 
-                except Exception as e:
-                    error_str = str(e).lower()
-                    logger.error(f"Error during analysis: {str(e)}")
-
-                    # User-friendly error messages based on error type
-                    if "quota" in error_str or "quota exceeded" in error_str:
-                        st.error("⚠️ We're experiencing high demand! API quota exceeded. Please try again later.")
-                    elif "rate limit" in error_str or "429" in error_str:
-                        st.error("⏳ Too many requests right now. Please wait a moment and try again.")
-                    elif "503" in error_str or "service unavailable" in error_str:
-                        st.error("🔧 Service temporarily unavailable. Please try again in a few minutes.")
-                    else:
-                        st.error("An error occurred during analysis. Please try again.")
-
-                    # Clean up on error too
-                    cleanup_temp_files()
-            else:
-                st.error("Our service is temporarily unavailable. Please try again in a few minutes.")
+def run_batch_submission(
+    submission: Dict[str, Any],
+    config: Dict[str, Any],
+    api_key: Optional[str],
+    fake_latency: Optional[float],
+) -> Dict[str, Any]:
+    """
+    Runs one submission through the same steps as the app (sanitize, crisis triage,
+    screenshots, four agents) and returns a result record for the output JSONL.
+    """
+    record: Dict[str, Any] = {"id": submission["id"]}
+    start = time.perf_counter()
+    try:
+        sanitized_input = sanitize_input(submission.get("text", ""), config.get('safety'))
+        triage = classify_crisis(sanitized_input, config.get('crisis'))
+        record["crisis"] = triage["is_crisis"]
+        record["crisis_resources"] = triage["show_resources"]
+        record["crisis_score"] = triage["score"]
+
+        if triage["is_crisis"]:
+            # Same short-circuit as the app: one gentle response from Maya
+            agents = build_batch_agents(config, api_key, fake_latency)
+            prompt = config['crisis']['response_prompt'].format(user_input=sanitized_input)
+            record["agents"] = {'therapist': run_agent(agents['therapist'], prompt, [])}
+        else:
+            prepared_images = []
+            seen_hashes = set()
+            for image_path in submission.get("images", []):
+                path = Path(image_path)
+                prepared = prepare_image(path.name, path.read_bytes())
+                if prepared["sha256"] not in seen_hashes:
+                    seen_hashes.add(prepared["sha256"])
+                    prepared_images.append(prepared)
+
+            budget = plan_request_budget(config, sanitized_input, prepared_images)
+            record["estimated_input_tokens"] = budget["estimated_total"]
+            record["compactions"] = budget["compactions"]
+
+            agents = build_batch_agents(config, api_key, fake_latency, budget["music_recommendations"])
+            images = [prepared["image"] for prepared in budget["images"]]
+            record["agents"] = {
+                key: run_agent(
+                    agents[key],
+                    config['agents'][key]['runtime_prompt'].format(user_input=budget["user_input"]),
+                    images,
+                    budget["estimates"][key],
+                )
+                for key in AGENT_ORDER
+            }
+    except Exception as e:
+        logger.error(f"Error processing submission {submission['id']}: {str(e)}")
+        record["error"] = str(e)
 
-    # Footer section
-    st.markdown("---")
-    if social_urls["email"]:
-        st.markdown(f"""
-<div style="text-align: center;">
-<h3>👨‍💻 A Humble Request</h3>
-<p>It takes 10s to break a system, but days to build one. Please spare my API credits!</p>
-<p>Rather than stress-testing, <a href="mailto:{social_urls['email']}">drop me a mail</a> and I'll share the full list of limitations myself. Let's collaborate instead!</p>
-</div>
-        """, unsafe_allow_html=True)
+    record["total_latency_s"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def load_batch_checkpoint(output_path: Path) -> set:
+    """Ids already completed in a previous run (records without an error)"""
+    completed = set()
+    if not output_path.exists():
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line may be partial if the previous run was killed mid-write
+                continue
+            if "error" not in record:
+                completed.add(record["id"])
+    return completed
+
+
+def run_batch(
+    input_path: Path,
+    output_path: Path,
+    config: Dict[str, Any],
+    concurrency: int = 4,
+    fake_latency: Optional[float] = None,
+) -> Dict[str, int]:
+    """
+    Headless batch mode: runs every submission in a JSONL file through the pipeline.
+    Each input line is {"id": optional, "text": ..., "images": [optional paths]}.
+    Results are appended to the output JSONL as they finish, which doubles as the
+    checkpoint: rerunning with the same output file skips completed ids.
+    """
+    api_key = None if fake_latency is not None else get_default_api_key()
+    if fake_latency is None and not api_key:
+        raise ValueError("DEFAULT_GEMINI_API_KEY is not set (use --fake for offline runs)")
+
+    with open(input_path, "r", encoding="utf-8") as f:
+        submissions = []
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                submission = json.loads(line)
+                submission["id"] = str(submission.get("id", line_number))
+                submissions.append(submission)
+
+    completed = load_batch_checkpoint(output_path)
+    pending = [submission for submission in submissions if submission["id"] not in completed]
+    logger.info(f"Batch: {len(submissions)} submissions, {len(completed)} already done, {len(pending)} to run")
+
+    stats = {"completed": 0, "failed": 0, "skipped": len(submissions) - len(pending)}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(output_path, "a", encoding="utf-8") as out:
+        futures = [executor.submit(run_batch_submission, submission, config, api_key, fake_latency) for submission in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            stats["failed" if "error" in record else "completed"] += 1
+            logger.info(f"Batch progress: {stats['completed'] + stats['failed']}/{len(pending)} (id={record['id']})")
+
+    logger.info(f"Batch finished: {stats}")
+    return stats
+
+
+def cli(argv: Optional[List[str]] = None):
+    """
+    Command-line entry point for running without the Streamlit UI:
+      python ai_breakup_recovery_agent.py batch submissions.jsonl results.jsonl --concurrency 8
+      python ai_breakup_recovery_agent.py batch submissions.jsonl results.jsonl --fake
+      python ai_breakup_recovery_agent.py eval-crisis
+      python ai_breakup_recovery_agent.py bench-scanner
+    """
+    parser = argparse.ArgumentParser(description="Breakup Recovery Squad headless tools")
+    parser.add_argument("--config", type=Path, default=CONFIG_PATH, help="Prompts/config YAML to use")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = subparsers.add_parser("batch", help="Run a JSONL of submissions through the four agents")
+    batch_parser.add_argument("input", type=Path)
+    batch_parser.add_argument("output", type=Path)
+    batch_parser.add_argument("--concurrency", type=int, default=4)
+    batch_parser.add_argument("--fake", action="store_true", help="Use offline fake agents instead of Gemini")
+    batch_parser.add_argument("--fake-latency", type=float, default=0.0, help="Simulated seconds per fake agent call")
+
+    eval_parser = subparsers.add_parser("eval-crisis", help="Precision/recall of crisis triage on a labeled set")
+    eval_parser.add_argument("--eval-set", type=Path, default=CRISIS_EVAL_PATH)
+
+    subparsers.add_parser("bench-scanner", help="Micro-benchmark the input safety scanner")
+    subparsers.add_parser("bench-crisis", help="Micro-benchmark the crisis classifier")
+
+    args = parser.parse_args(argv)
+    with open(args.config, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    # Singletons that read config on their own (e.g. circuit breakers) must see --config too
+    global _cli_config
+    _cli_config = config
+
+    if args.command == "batch":
+        results = run_batch(
+            args.input,
+            args.output,
+            config,
+            concurrency=args.concurrency,
+            fake_latency=args.fake_latency if args.fake else None,
+        )
+    elif args.command == "eval-crisis":
+        results = evaluate_crisis_classifier(config['crisis'], args.eval_set)
+    elif args.command == "bench-scanner":
+        results = benchmark_input_scanner()
     else:
-        st.markdown("""
-<div style="text-align: center;">
-<h3>👨‍💻 A Humble Request</h3>
-<p>It takes 10s to break a system, but days to build one. Please spare my API credits!</p>
-<p>Rather than stress-testing, drop me a mail and I'll share the full list of limitations myself. Let's collaborate instead!</p>
-</div>
-        """, unsafe_allow_html=True)
+        results = benchmark_crisis_classifier(config['crisis'])
+
+    print(json.dumps(results, indent=2))
 
 
 if __name__ == "__main__":
-    main()
+    # `streamlit run` executes this file as __main__ too; only use the CLI outside Streamlit
+    if st.runtime.exists():
+        main()
+    else:
+        cli()